@@ -0,0 +1,122 @@
+import csv
+import json
+
+
+# Buffer of the export file, records are written to it one at a time
+BUFFER_SIZE = 1024 * 1024
+
+CSV_HEADER = ['name', 'phones', 'birthday', 'address', 'email', 'notes']
+
+# vCard lines longer than this are folded
+VCARD_LINE_LENGTH = 75
+
+# json.dumps with options builds a new encoder on every call
+encode_json = json.JSONEncoder(ensure_ascii=False).encode
+
+
+def csv_rows(records):
+    """
+    Yields the CSV rows of records, header first, in the layout read by the importer:
+    phones separated by "; ", notes by line breaks.
+    """
+    yield CSV_HEADER
+    for record in records:
+        yield [
+            record.name.value,
+            '; '.join(phone.value for phone in record.phones),
+            record.birthday.value.strftime('%d.%m.%Y') if record.birthday else '',
+            record.address.value if record.address else '',
+            record.email.value if record.email else '',
+            '\n'.join(note.value for note in record.notes),
+        ]
+
+
+def write_csv(file, records):
+    writer = csv.writer(file)
+    count = -1
+    for row in csv_rows(records):
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def json_record(record):
+    return {
+        'name': record.name.value,
+        'phones': [phone.value for phone in record.phones],
+        'birthday': record.birthday.value.date().isoformat() if record.birthday else None,
+        'address': record.address.value if record.address else None,
+        'email': record.email.value if record.email else None,
+        'notes': [note.value for note in record.notes],
+    }
+
+
+def write_jsonl(file, records):
+    count = 0
+    for record in records:
+        file.write(encode_json(json_record(record)))
+        file.write('\n')
+        count += 1
+    return count
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace(',', '\\,').replace(';', '\\;')
+
+
+def _fold(line):
+    # Continuation lines start with a space, which is not part of the value
+    if len(line) <= VCARD_LINE_LENGTH:
+        return line + '\r\n'
+    parts = [line[:VCARD_LINE_LENGTH]]
+    parts.extend(line[start:start + VCARD_LINE_LENGTH - 1]
+                 for start in range(VCARD_LINE_LENGTH, len(line), VCARD_LINE_LENGTH - 1))
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def vcard_lines(record):
+    name = _escape(record.name.value)
+    yield 'BEGIN:VCARD'
+    yield 'VERSION:3.0'
+    yield f'FN:{name}'
+    yield f'N:{name};;;;'
+    for phone in record.phones:
+        yield f'TEL:{phone.value}'
+    if record.birthday:
+        yield f'BDAY:{record.birthday.value.date().isoformat()}'
+    if record.address:
+        yield f'ADR:;;{_escape(record.address.value)};;;;'
+    if record.email:
+        yield f'EMAIL:{record.email.value}'
+    for note in record.notes:
+        yield f'NOTE:{_escape(note.value)}'
+    yield 'END:VCARD'
+
+
+def write_vcard(file, records):
+    count = 0
+    for record in records:
+        file.write(''.join(_fold(line) for line in vcard_lines(record)))
+        count += 1
+    return count
+
+
+EXPORT_FORMATS = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+    'vcard': write_vcard,
+}
+
+
+def export_contacts(book, export_format, path, search_query=None):
+    """
+    Writes the contacts of the book, or those matching search_query (see
+    AddressBook.find_contacts), to path in one of EXPORT_FORMATS.
+
+    Records are taken from the book one at a time and written through a
+    buffered file, so neither the book nor the output is held in memory.
+    Returns the number of exported contacts.
+    """
+    write = EXPORT_FORMATS[export_format]
+    with open(path, 'w', newline='', encoding='utf-8', buffering=BUFFER_SIZE) as file:
+        return write(file, book.iter_contacts(search_query))
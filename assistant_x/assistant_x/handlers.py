@@ -1,56 +1,141 @@
-from assistant_x.helpers import get_alien, print_contacts_table, print_help
-from assistant_x.models import Birthday, Email, Phone, Record, AddressBook
+from assistant_x.helpers import BirthdayList, CommandError, ContactList, ContactStream, ItemList, NoteList, Reply, StatsTable, get_alien, print_help
+from assistant_x.models import Birthday, Email, Phone, Record
+from assistant_x.stats import STATS
+from assistant_x.storage import BookLocked, get_persister, get_storage
+from collections import OrderedDict
 from functools import wraps
 import datetime
-import pickle
-import os
+
+
+# Number of read-only query results kept by cached_query
+QUERY_CACHE_SIZE = 256
+# Rows (contacts, birthdays or notes) the cached results may hold altogether; a result
+# holding more than a tenth of them, e.g. of find --limit 0, is not cached
+QUERY_CACHE_ROWS = 10000
+
+# Contacts shown by all and find unless --size or --limit say otherwise
+DEFAULT_PAGE_SIZE = 50
+
+_query_cache = OrderedDict()
 
 
 # Handler decorator
 def save_book(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
-        file_name = "ab_data.bin"
         book = kwargs.get("book")
-        result = func(*args, **kwargs)
-        if not book:
+        # Keeps a background flush from reading the book halfway through a change
+        with get_storage().lock:
+            result = func(*args, **kwargs)
+        if book is None:
             print("Contact cannot be saved. Please try again.")
         else:
-            usr_dir = os.path.expanduser("~")
-            file_path = os.path.join(usr_dir, file_name)
-            with open(file_path, "wb") as file:
-                pickle.dump(book, file)
+            # Only the records changed by the handler are written
+            try:
+                get_persister().changed(book)
+            except BookLocked as error:
+                return CommandError(str(error))
         return result
 
+    # Lets the server tell the handlers that change the book from the read-only ones
+    wrapper.changes_book = True
     return wrapper
 
 
+# Read-only handler decorator
+def reads_book(func):
+    """
+    Keeps the saves of other processes from being applied to the book while a
+    read-only handler reads it. The background flush (see Persister) applies
+    them before it saves, from its own thread, and holds the lock of the
+    storage meanwhile, as handlers that change the book do (see save_book).
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with get_storage().lock:
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def cached_query(daily=False):
+    """
+    Caches the result of a read-only handler.
+
+    Results are keyed by the handler, its arguments and the generation of the
+    book, which changes with every change to the book, so a stale result is
+    never returned. Results of handlers that depend on the current date
+    (daily=True) are also keyed by the date. A ContactStream is not kept, it
+    can only be read once, and neither are results too large for
+    QUERY_CACHE_ROWS; the oldest results go first when the cache is full.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(args, book):
+            key = (func.__name__, tuple(args), book.generation, datetime.date.today() if daily else None)
+            try:
+                _query_cache.move_to_end(key)
+                return _query_cache[key]
+            except KeyError:
+                pass
+
+            result = func(args, book)
+            if isinstance(result, ContactStream):
+                # Read once, and as large as the book
+                return result
+            if _rows(result) > QUERY_CACHE_ROWS // 10:
+                return result
+            _query_cache[key] = result
+            rows = sum(_rows(cached) for cached in _query_cache.values())
+            while len(_query_cache) > QUERY_CACHE_SIZE or rows > QUERY_CACHE_ROWS:
+                _, oldest = _query_cache.popitem(last=False)
+                rows -= _rows(oldest)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def _rows(result):
+    return len(result) if isinstance(result, ItemList) else 1
+
+
 # Handle the address book
 def get_address_book():
-    usr_dir = os.path.expanduser("~")
-    file_path = os.path.join(usr_dir, "ab_data.bin")
+    return get_storage().load()
+
+
+def take_number_option(args, option, default):
+    """
+    Removes "option N" from the command arguments.
+    Returns the remaining arguments and N (default when the option is missing);
+    raises ValueError when N is not a non-negative number.
+    """
+    if option not in args:
+        return args, default
+    index = args.index(option)
+    if index + 1 >= len(args) or not args[index + 1].isdigit():
+        raise ValueError(option)
+    return args[:index] + args[index + 2:], int(args[index + 1])
 
-    try:
-        with open(file_path, "rb") as file:
-            # return AddressBook()
-            return pickle.load(file)
-    except FileNotFoundError:
-        return AddressBook()
+
+def contact_not_found(name, book):
+    suggestions = book.suggest(name)
+    if suggestions:
+        return CommandError(f"Contact {name} not found. Did you mean: {', '.join(suggestions)}?")
+    return CommandError(f"Contact {name} not found")
 
 
 # Handler functions
 @save_book
 def add_handler(args, book):
     if len(args) < 3:
-        return "Invalid command usage: add <name> <phone>"
-    command = ' '.join(args)
-    parts = command.split(" ", 2)
-    name, phone = parts[1:]
-
+        return CommandError("Invalid command usage: add <name> <phone>")
+    name, phone = args[1], args[2]
     if len(args) > 3:
-        parts = parts[2].split(" ", 2)
-        name += ' '+ parts[0]
-        phone = parts[1]
+        # A name of two words, as typed at the prompt
+        name, phone = f"{args[1]} {args[2]}", args[3]
 
     record = Record(name)
 
@@ -58,7 +143,7 @@ def add_handler(args, book):
         if not Phone(phone).validate():
             raise ValueError("Invalid phone number")
     except ValueError:
-        return "Invalid phone number. Please try again."
+        return CommandError("Invalid phone number. Please try again.")
 
     record.add_phone(phone)
     book.add_record(record)
@@ -68,33 +153,53 @@ def add_handler(args, book):
 @save_book
 def change_handler(args, book):
     if len(args) != 3:
-        return "Invalid command usage: change <name> <new_phone>"
+        return CommandError("Invalid command usage: change <name> <new_phone>")
     name, new_phone = args[1:]
     try:
         # Validate the new phone number
         Phone(new_phone)
     except ValueError:
-        return "Invalid phone number. Please try again."
+        return CommandError("Invalid phone number. Please try again.")
 
     # Attempt to find the contact
     contact = book.find(name)
 
     # If contact is not found, return an error message
     if not contact:
-        return f"Contact {name} not found"
+        return contact_not_found(name, book)
 
     book.change_phone(name, new_phone)
     return f"Phone number for {name} changed"
 
 
+@reads_book
+@cached_query()
 def search_handler(args, book):
+    usage = CommandError("Invalid command usage: find [--ranked | --fuzzy] [--limit N] <query>")
+    ranked = '--ranked' in args
+    fuzzy = '--fuzzy' in args
+    args = [arg for arg in args if arg not in ('--ranked', '--fuzzy')]
+    try:
+        args, limit = take_number_option(args, '--limit', DEFAULT_PAGE_SIZE)
+    except ValueError:
+        return usage
     if len(args) != 2:
-        return "Invalid command usage: find <query>"
+        return usage
     query = args[1]
-    contacts = book.find_contacts(query)
+    if fuzzy:
+        contacts = book.find_similar(query)
+        total = len(contacts)
+    else:
+        # Only the contacts that are shown are read
+        names = book.find_names(query, ranked=ranked)
+        total = len(names)
+        contacts = [book.find(name) for name in (names[:limit] if limit else names)]
     if contacts:
-        print_contacts_table(contacts)
-        return ''
+        contacts = contacts[:limit] if limit else contacts
+        footer = None
+        if len(contacts) < total:
+            footer = f"Showing {len(contacts)} of {total} contacts, use --limit to see more (--limit 0 for all)"
+        return ContactList(contacts, total, footer)
     else:
         return "No contacts found"
 
@@ -103,19 +208,17 @@ def search_handler(args, book):
 @save_book
 def change_address_handler(args, book):
     if len(args) < 3:
-        return "Invalid command usage: change_address <name> <new_address>"
-    command = ' '.join(args)
-    parts = command.split(" ", 2)
-    name, new_address = parts[1:]
+        return CommandError("Invalid command usage: change_address <name> <new_address>")
+    name, new_address = args[1], ' '.join(args[2:])
 
     # Attempt to find the contact
     contact = book.find(name)
 
     # If contact is not found, return an error message
     if not contact:
-        return f"Contact {name} not found"
+        return contact_not_found(name, book)
     else:
-        contact.add_address(new_address)
+        book.change_address(name, new_address)
 
     return f"Address for {name} changed to {new_address}"
 
@@ -124,7 +227,7 @@ def change_address_handler(args, book):
 @save_book
 def change_email_handler(args, book):
     if len(args) != 3:
-        return "Invalid command usage: change_email <name> <new_email>"
+        return CommandError("Invalid command usage: change_email <name> <new_email>")
     name, new_email = args[1:]
 
     # Attempt to find the contact
@@ -132,7 +235,7 @@ def change_email_handler(args, book):
 
     # If contact is not found, return an error message
     if not contact:
-        return f"Contact {name} not found"
+        return contact_not_found(name, book)
 
     book.change_email(name, new_email)
     return f"Email for {name} changed"
@@ -142,231 +245,242 @@ def change_email_handler(args, book):
 @save_book
 def delete_handler(args, book):
     if len(args) != 2:
-        return "Invalid command usage: delete <name>"
+        return CommandError("Invalid command usage: delete <name>")
     name = args[1]
     if book.find(name):
         book.delete(name)
         return f"Contact {name} deleted"
     else:
-        return f"Contact {name} not found"
+        return contact_not_found(name, book)
 
 
+@reads_book
+@cached_query()
 def all_handler(args, book):
-    result = book.show_all()
-    if result != "Contacts were not added":
-        print_contacts_table(result)
-        return ''
-    else:
-        return result
+    usage = CommandError("Invalid command usage: all [--page N] [--size M]")
+    try:
+        args, page = take_number_option(args, '--page', 1)
+        args, size = take_number_option(args, '--size', DEFAULT_PAGE_SIZE)
+    except ValueError:
+        return usage
+    if len(args) != 1 or page < 1:
+        return usage
+
+    total = len(book)
+    if not total:
+        return "Contacts were not added"
+    if not size:
+        return ContactStream(book.iter_contacts(), total)
+
+    pages = -(-total // size)
+    if page > pages:
+        return CommandError(f"There are only {pages} pages of {size} contacts")
+    footer = None
+    if pages > 1:
+        footer = f"Page {page} of {pages} ({total} contacts), all --page N for another page, --size 0 for all"
+    return ContactList(book.page((page - 1) * size, size), total, footer)
 
 
 @save_book
 def add_address_hadler(args, book):
     if len(args) < 3:
-        return "Invalid command usage: add_address <name> <address>"
-    command = ' '.join(args)
-    parts = command.split(" ", 2)
-    name, address = parts[1:]
+        return CommandError("Invalid command usage: add_address <name> <address>")
+    name, address = args[1], ' '.join(args[2:])
     contact = book.find(name)
     if contact:
         contact.add_address(address)
         return f"Address added for {name}"
     else:
-        return f"Contact {name} not found"
+        return contact_not_found(name, book)
 
 
 @save_book
 def add_email_handler(args, book):
     if len(args) != 3:
-        return "Invalid command usage: add-email <name> <email>"
+        return CommandError("Invalid command usage: add-email <name> <email>")
     name, email = args[1:]
     contact = book.find(name)
     if contact:
         email_obj = Email(email)
         if email_obj.value is None:  # Check if email is invalid
-            return "Invalid email address. Please try again."
+            return CommandError("Invalid email address. Please try again.")
         else:
             contact.add_email(email)
             return f"Email added for {name}"
     else:
-        return f"Contact {name} not found"
+        return contact_not_found(name, book)
 
 
 @save_book
 def add_birthday_handler(args, book):
     if len(args) != 3:
-        return "Invalid command usage: add-birthday <name> <birthday>"
+        return CommandError("Invalid command usage: add-birthday <name> <birthday>")
     name, birthday = args[1:]
     contact = book.find(name)
     if contact:
-        birthday_obj = Birthday(birthday)
+        try:
+            birthday_obj = Birthday(birthday)
+        except ValueError as error:
+            return CommandError(str(error))
         contact.add_birthday(birthday_obj)
         return f"Birthday added for {name}"
     else:
-        return f"Contact {name} not found"
+        return contact_not_found(name, book)
 
 
+@reads_book
 def show_birthday_handler(args, book):
     if len(args) != 2:
-        return "Invalid command usage: show-birthday <name>"
+        return CommandError("Invalid command usage: show-birthday <name>")
     name = args[1]
     contact = book.find(name)
     if contact and contact.birthday:
         birthday_date = contact.birthday.value.strftime('%d.%m.%Y')
-        return f"Birthday for {name}: {birthday_date}"
+        return Reply(f"Birthday for {name}: {birthday_date}", name=name,
+                     birthday=contact.birthday.value.date().isoformat())
     else:
         return f"Contact {name} does not have a birthday or not found"
 
 
+@reads_book
+@cached_query(daily=True)
 def show_birthdays_next_week_handler(args, book):
-    today = datetime.date.today()
-    next_week = today + datetime.timedelta(days=7)
-    birthdays = []
-
-    for contact in book.values():
-        if contact.birthday:
-            birthday_date = datetime.date(contact.birthday.value.year, contact.birthday.value.month,
-                                          contact.birthday.value.day,
-                                          )
-            if (birthday_date.day, birthday_date.month) >= (
-                    today.day,
-                    today.month,) and (
-                    birthday_date.day, birthday_date.month) <= (next_week.day, next_week.month,
-                                                                ):
-                birthdays.append(contact)
+    birthdays = book.upcoming_birthdays(7)
     if birthdays:
-        for birthday in birthdays:
-            print(f"Upcoming birthdays within the next week:\n {birthday}")
+        return BirthdayList(birthdays, "Upcoming birthdays within the next week:", detailed=True)
     else:
-        "No birthdays within the next week."
-
-    return ""
+        return "No birthdays within the next week."
 
 
+@reads_book
+@cached_query(daily=True)
 def show_birthdays_in_period_handler(args, book):
     if len(args) != 2:
-        return "Invalid command usage: birthdays-in-period <days>"
+        return CommandError("Invalid command usage: birthdays-in-period <days>")
 
     try:
         days = int(args[1])
     except ValueError:
-        return "Invalid number of days"
-
-    today = datetime.date.today()
-    end_date = today + datetime.timedelta(days=days)
-
-    upcoming_birthdays = []
+        return CommandError("Invalid number of days")
 
-    for contact in book.values():
-        if contact.birthday:
-            birthday_month_day = (
-                contact.birthday.value.month,
-                contact.birthday.value.day,
-            )
-            today_month_day = (today.month, today.day)
-            end_month_day = (end_date.month, end_date.day)
-
-            if today_month_day <= birthday_month_day <= end_month_day:
-                upcoming_birthdays.append((contact, contact.days_to_birthday()))
+    upcoming_birthdays = book.upcoming_birthdays(days)
 
     if upcoming_birthdays:
-        result = "Upcoming birthdays in the specified period:\n"
-        for contact, days_left in upcoming_birthdays:
-            result += f"{contact.name.value}: {days_left} days left\n"
+        return BirthdayList(upcoming_birthdays, "Upcoming birthdays in the specified period:")
     else:
-        result = "No birthdays in the specified period."
-
-    return result
+        return "No birthdays in the specified period."
 
 
 # Added show email handler
+@reads_book
 def show_email_handler(args, book):
     if len(args) != 2:
-        return "Invalid command usage: show_email <name>"
+        return CommandError("Invalid command usage: show_email <name>")
     name = args[1]
     email = book.show_email(name)
     if email:
-        return f"Email for {name}: {email}"
+        contact = book.find(name)
+        return Reply(f"Email for {name}: {email}", name=name,
+                     email=contact.email.value if contact and contact.email else None)
     else:
         return f"No email found for {name}"
 
 
 # Added show address handler
+@reads_book
 def show_address_handler(args, book):
     if len(args) != 2:
-        return "Invalid command usage: show_address <name>"
+        return CommandError("Invalid command usage: show_address <name>")
     name = args[1]
     address = book.show_address(name)
     if address:
-        return f"Address for {name}: {address}"
+        contact = book.find(name)
+        return Reply(f"Address for {name}: {address}", name=name,
+                     address=contact.address.value if contact and contact.address else None)
     else:
         return f"No address found for {name}"
 
 
-# Added delete handler
-@save_book
-def delete_handler(args, book):
-    if len(args) != 2:
-        return "Invalid command usage: delete <name>"
-    name = args[1]
-    if book.find(name):
-        book.delete(name)
-        return f"Contact {name} deleted"
-    else:
-        return f"Contact {name} not found"
-
-
 @save_book
 def add_note_handler(args, book):
     if len(args) != 3:
-        return "Invalid command usage: add-note <name> <note>"
+        return CommandError("Invalid command usage: add-note <name> <note>")
     name, note = args[1:]
     contact = book.find(name)
     if contact:
-        contact.add_note(note)
+        try:
+            contact.add_note(note)
+        except ValueError as error:
+            return CommandError(str(error))
         return f"Note added for {name}"
     else:
-        return f"Contact {name} not found"
+        return contact_not_found(name, book)
 
 
 @save_book
 def edit_note_handler(args, book):
     if len(args) < 4:
-        return "Invalid command usage: edit-note <name> <note_index> <new_note>"
+        return CommandError("Invalid command usage: edit-note <name> <note_index> <new_note>")
     name = args[1]
+    if not args[2].isdigit():
+        return CommandError("The note index must be a number")
     note_index = int(args[2])
     new_note = ' '.join(args[3:])
     contact = book.find(name)
     if contact:
         result = contact.edit_note(note_index, new_note)
         if result == "Invalid note index":
-            return f"Invalid note index for contact {name}"
+            return CommandError(f"Invalid note index for contact {name}")
         else:
             return f"Note edited for {name}"
+    else:
+        return contact_not_found(name, book)
+
+
+@reads_book
+@cached_query()
+def find_note_handler(args, book):
+    if len(args) < 2:
+        return CommandError("Invalid command usage: find-note <terms>")
+    terms = ' '.join(args[1:])
+    hits = book.find_notes(terms)
+    if not hits:
+        return "No notes found"
+    return NoteList(hits, terms)
 
 
+@reads_book
 def show_note_handler(args, book):
     if len(args) != 2:
-        return "Invalid command usage: note <name>"
+        return CommandError("Invalid command usage: note <name>")
     name = args[1]
-    return book.show_notes(name) or f"Contact {name} not found"
+    contact = book.find(name)
+    if not contact:
+        return contact_not_found(name, book)
+    return Reply(book.show_notes(name), name=name, notes=[note.value for note in contact.notes])
 
 
 @save_book
 def delete_note_handler(args, book):
     if len(args) != 3:
-        return "Invalid command usage: delete-note <name> <index>"
+        return CommandError("Invalid command usage: delete-note <name> <index>")
     name = args[1]
+    if not args[2].isdigit():
+        return CommandError("The note index must be a number")
     note_index = int(args[2])
     contact = book.find(name)
     if contact:
         result = contact.remove_note(note_index)
         if result == "Invalid note index":
-            return f"Invalid note index for contact {name}"
+            return CommandError(f"Invalid note index for contact {name}")
         else:
             return f"Note deleted for {name}"
     else:
-        return f"Contact {name} not found"
+        return contact_not_found(name, book)
+
+
+def stats_handler(args=None, book=None):
+    return StatsTable(STATS.rows())
 
 
 def help_handler(args=None, book=None):
@@ -374,7 +488,40 @@ def help_handler(args=None, book=None):
     return ''
 
 
+@save_book
+def import_handler(args, book):
+    from assistant_x.importer import format_import_report, import_contacts
+
+    if len(args) < 2:
+        return CommandError("Invalid command usage: import <file.csv | file.vcf>")
+    path = ' '.join(args[1:])
+    try:
+        imported, errors = import_contacts(path, book)
+    except (OSError, UnicodeDecodeError, ValueError) as error:
+        return CommandError(f"Cannot import {path}: {error}")
+    return format_import_report(path, imported, errors)
+
+
+@reads_book
+def export_handler(args, book):
+    from assistant_x.exporter import EXPORT_FORMATS, export_contacts
+
+    formats = ' | '.join(EXPORT_FORMATS)
+    if len(args) < 3:
+        return CommandError(f"Invalid command usage: export <{formats}> <path> [query]")
+    export_format, path = args[1:3]
+    if export_format not in EXPORT_FORMATS:
+        return CommandError(f"Unknown export format {export_format}, use one of: {formats}")
+    search_query = ' '.join(args[3:]) or None
+    try:
+        count = export_contacts(book, export_format, path, search_query)
+    except OSError as error:
+        return CommandError(f"Cannot export to {path}: {error}")
+    return f"Exported {count} contacts to {path}"
+
+
 def close_handler(args=None, book=None):
+    get_persister().close()
     print("Goodbye! 🛸")
     print(get_alien())
     exit(0)
@@ -1,25 +1,349 @@
-import colorama
+from itertools import chain, islice
+import sys
 
 
-def print_contacts_table(contact_list):
-    result = [
-        ['Name', 'Phone Numbers', 'Birthday', 'Address', 'Email']
-    ]
+CONTACT_HEADER = ['Name', 'Phone Numbers', 'Birthday', 'Address', 'Email']
+
+# Longest cell shown in each column of the contacts table, longer ones are cut
+CONTACT_COLUMN_CAPS = [32, 36, 10, 40, 36]
+
+# Rows whose cells decide the column widths of a streamed table
+WIDTH_SAMPLE = 100
+
+# Rows of a streamed table written to the terminal at a time
+WRITE_ROWS = 500
+
+# Values of --output: the text view, or machine-readable results without any formatting pass
+OUTPUT_FORMATS = ('table', 'json', 'jsonl', 'tsv')
+
+
+class CommandError(str):
+    """
+    Reply of a command that could not be carried out.
+
+    It is printed like any other reply; batch mode counts these to set its exit code.
+    """
+
+
+class Reply(str):
+    """
+    Text reply of a handler that also carries its data, for the machine-readable output formats.
+
+    Attributes:
+        data (dict): Values the reply is about, e.g. the name and email of a contact.
+    """
+
+    def __new__(cls, text, **data):
+        reply = super().__new__(cls, text)
+        reply.data = data
+        return reply
+
+
+class ItemList(list):
+    """
+    Base class for handler replies that are a list of items.
+
+    Printed as text by default; with a machine-readable output format every
+    item is written as a record instead (see print_result).
+
+    Attributes:
+        columns (tuple): Keys of the records, in the order of the TSV columns.
+
+    Methods:
+        record(item): Returns the item as a dict.
+    """
+
+    columns = ()
+
+    def record(self, item):
+        raise NotImplementedError
+
+
+class ContactList(ItemList):
+    """
+    List of contacts returned by a handler, printed as a table.
+
+    The table is rendered on first use and kept, so a cached result is not
+    rendered again.
+
+    Attributes:
+        total (int): Number of contacts found, of which this list may hold only one page.
+        footer (str): Line printed under the table, e.g. which page is shown.
+
+    Methods:
+        write(out): Streams the table to a file, see iter_table_lines.
+    """
+
+    columns = ('name', 'phones', 'birthday', 'address', 'email', 'notes')
+    rendered = None
+
+    def __init__(self, contacts=(), total=None, footer=None):
+        super().__init__(contacts)
+        self.total = len(self) if total is None else total
+        self.footer = footer
+
+    def record(self, contact):
+        from assistant_x.exporter import json_record
+
+        return json_record(contact)
+
+    def lines(self):
+        yield from iter_table_lines(contact_rows(self), CONTACT_COLUMN_CAPS)
+        if self.footer:
+            yield self.footer
+
+    def write(self, out=None):
+        if self.rendered is not None:
+            (out or sys.stdout).write(self.rendered + '\n')
+        else:
+            write_lines(self.lines(), out)
+
+    def __str__(self):
+        if self.rendered is None:
+            self.rendered = '\n'.join(self.lines())
+        return self.rendered
+
+
+class ContactStream(ContactList):
+    """
+    Contacts of the whole book, printed as they are read instead of held in a list.
+
+    The contacts can be read once, so the query cache never keeps a stream,
+    and it is not rendered as a whole either.
+
+    Attributes:
+        contacts (iterator): The contacts, read from a snapshot of the book (see AddressBook.iter_contacts).
+    """
+
+    def __init__(self, contacts, total):
+        super().__init__((), total)
+        self.contacts = contacts
+
+    def __iter__(self):
+        return iter(self.contacts)
+
+    def __len__(self):
+        return self.total
+
+    def __str__(self):
+        return '\n'.join(self.lines())
+
+
+class BirthdayList(ItemList):
+    """
+    Upcoming birthdays, as (contact, days left) pairs.
+
+    Attributes:
+        title (str): First line of the text.
+        detailed (bool): Show the whole contact instead of the name and days left.
+    """
+
+    columns = ('name', 'birthday', 'days_left')
+
+    def __init__(self, birthdays, title, detailed=False):
+        super().__init__(birthdays)
+        self.title = title
+        self.detailed = detailed
+
+    def record(self, item):
+        contact, days_left = item
+        return {
+            'name': contact.name.value,
+            'birthday': contact.birthday.value.date().isoformat(),
+            'days_left': days_left,
+        }
+
+    def __str__(self):
+        result = self.title + "\n"
+        for contact, days_left in self:
+            if self.detailed:
+                result += f" {contact}\n"
+            else:
+                result += f"{contact.name.value}: {days_left} days left\n"
+        return result
+
+
+class NoteList(ItemList):
+    """
+    Notes found by find-note, as (name, note index, text, score) tuples.
+
+    Attributes:
+        terms (str): Terms the notes were searched for.
+    """
+
+    columns = ('name', 'index', 'note', 'score')
+
+    def __init__(self, hits, terms):
+        super().__init__(hits)
+        self.terms = terms
+
+    def record(self, item):
+        return dict(zip(self.columns, item))
+
+    def __str__(self):
+        result = f"Notes matching '{self.terms}':\n"
+        for name, note_index, note, score in self:
+            result += f"{name} [{note_index}]: {note} ({score:.2f})\n"
+        return result
+
+
+class StatsTable(ItemList):
+    """
+    Counts and latencies of the commands and of the storage, as (kind, name, histogram)
+    tuples (see stats.Stats), printed as a table with times in milliseconds.
+    """
+
+    columns = ('kind', 'name', 'calls', 'errors', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'bytes', 'bytes_per_call')
+    header = ['Kind', 'Name', 'Calls', 'Errors', 'p50 ms', 'p95 ms', 'p99 ms', 'Max ms', 'Bytes', 'Bytes/call']
+
+    def record(self, item):
+        kind, name, histogram = item
+        size = histogram.size
+        return {
+            'kind': kind,
+            'name': name,
+            'calls': histogram.calls,
+            'errors': histogram.errors,
+            'p50_ms': round(histogram.percentile(0.5) * 1000, 3),
+            'p95_ms': round(histogram.percentile(0.95) * 1000, 3),
+            'p99_ms': round(histogram.percentile(0.99) * 1000, 3),
+            'max_ms': round(histogram.longest * 1000, 3),
+            'bytes': size,
+            'bytes_per_call': None if size is None else size // histogram.calls,
+        }
+
+    def __str__(self):
+        if not self:
+            return "Nothing was measured yet"
+        rows = [self.header]
+        for item in self:
+            rows.append(['' if value is None else str(value) for value in self.record(item).values()])
+        return format_table(rows, line_between_rows=False)
+
+
+def contact_rows(contact_list):
+    yield CONTACT_HEADER
     for contact in contact_list:
-        from datetime import datetime
-        result.append([contact.name.value, ', '.join(list(map(lambda x: x.value, contact.phones))),
+        yield [contact.name.value, ', '.join(list(map(lambda x: x.value, contact.phones))),
                contact.birthday.value.strftime('%d.%m.%Y') if contact.birthday else None,
-               contact.address, contact.email])
-    pretty_print_table(result)
+               contact.address, contact.email]
+
+
+def format_contacts_table(contact_list):
+    return format_table(list(contact_rows(contact_list)))
+
+
+def print_contacts_table(contact_list):
+    write_lines(iter_table_lines(contact_rows(contact_list), CONTACT_COLUMN_CAPS))
+
+
+def _tsv_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        value = ';'.join(map(str, value))
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _json_lines(total, records):
+    from assistant_x.exporter import encode_json
+
+    # One item per line, so the array is written in chunks like any other output
+    yield '{"total": %d, "items": [' % total
+    previous = None
+    for record in records:
+        if previous is not None:
+            yield previous + ','
+        previous = encode_json(record)
+    if previous is not None:
+        yield previous
+    yield ']}'
+
+
+def reply_object(result):
+    """
+    Returns the reply of a handler as a single JSON-serializable object, the one
+    --output json prints: {"total": ..., "items": [...]} for an item list,
+    {"error": ...} for a CommandError, {"message": ...} plus the data of a Reply
+    for other replies, or None for an empty reply.
+    """
+    if isinstance(result, ItemList):
+        return {'total': getattr(result, 'total', len(result)), 'items': list(map(result.record, result))}
+    if result is None or result == '':
+        return None
+    if isinstance(result, CommandError):
+        return {'error': str(result)}
+    return {'message': str(result), **getattr(result, 'data', {})}
+
+
+def print_result(result, output_format='table', out=None):
+    """
+    Prints the reply of a handler in one of OUTPUT_FORMATS.
+
+    The table format prints replies as text and streams contact tables instead
+    of building them as one string. The other formats write item lists record
+    by record, and other replies as one record: {"error": ...} for a
+    CommandError, {"message": ...} plus the data of a Reply, or {"message": ...}.
+    """
+    from assistant_x.exporter import encode_json
+
+    if output_format == 'table':
+        if isinstance(result, ContactList):
+            result.write(out)
+        else:
+            print(result, file=out)
+        return
+
+    if isinstance(result, ItemList):
+        columns = result.columns
+        records = map(result.record, result)
+        total = getattr(result, 'total', len(result))
+    else:
+        if result is None or result == '':
+            return
+        if isinstance(result, CommandError):
+            record = {'error': str(result)}
+        else:
+            record = {'message': str(result), **getattr(result, 'data', {})}
+        columns, records, total = tuple(record), [record], None
+
+    if output_format == 'json':
+        if total is None:
+            write_lines([encode_json(records[0])], out)
+        else:
+            write_lines(_json_lines(total, records), out)
+    elif output_format == 'jsonl':
+        write_lines((encode_json(record) for record in records), out)
+    elif columns == ('message',):
+        # Plain messages have nothing to tabulate
+        print(records[0]['message'], file=out)
+    else:
+        rows = ('\t'.join(_tsv_cell(record[column]) for column in columns) for record in records)
+        write_lines(chain(['\t'.join(columns)], rows), out)
+
+
+def failure_line(line_number, error, output_format='table'):
+    """
+    Returns the line batch mode writes to stderr for a command that failed:
+    {"line": N, "error": ...} for json and jsonl, the line number and the
+    error separated by a tab for tsv, "line N: error" for the table format.
+    """
+    from assistant_x.exporter import encode_json
+
+    if output_format in ('json', 'jsonl'):
+        return encode_json({'line': line_number, 'error': str(error)})
+    if output_format == 'tsv':
+        return f"{line_number}\t{_tsv_cell(str(error))}"
+    return f"line {line_number}: {error}"
 
 
 def print_help():
     print("Available commands:")
     commands = [
-        ['all', 'Show all contacts.'],
+        ['all [--page N] [--size M]', 'Show all contacts, 50 (or M, 0 for all) per page.'],
         ['add "<name>" <phone>', 'Add a new contact.'],
         ['change-number "<name>" <new_phone>', 'Change the phone number for a contact.'],
-        ['find <query>', 'Search for a contact by name or phone number.'],
+        ['find [--ranked | --fuzzy] [--limit N] <query>', 'Search for a contact by name or phone number, "<start>*" for names starting with <start>, "email:", "domain:", "address:" or "city:" to search those fields. Shows the first 50 (or N, 0 for all) contacts found.'],
         ['show-birthday "<name>"', 'Show the birthday for a contact.'],
         ['add-birthday "<name>" <birthday>', 'Show the birthday for a contact.'],
         ['birthdays-in-period <days>', 'Show upcoming birthdays in the specified period.'],
@@ -34,7 +358,11 @@ def print_help():
         ['add-note "<name>" <note>', 'Add a note for a contact.'],
         ['edit-note "<name>" <note_index> <new_note>', 'Edit a note for a contact.'],
         ['note "<name>"', 'Show all notes for a contact.'],
+        ['find-note <terms>', 'Find the notes that mention any of the terms, best matches first.'],
         ['delete-note "<name>" <index>', 'Delete a note for a contact.'],
+        ['import <file>', 'Import contacts from a CSV file with a header row or a vCard (.vcf) file.'],
+        ['export <csv | jsonl | vcard> <path> [query]', 'Export all contacts, or those found by a find query, to a file.'],
+        ['stats', 'Show how often each command ran and how long it took, and what loading and saving the book cost.'],
         ['help', 'Show available commands.'],
         ['close | exit', 'Close the application.']
     ]
@@ -42,6 +370,10 @@ def print_help():
 
 
 def pretty_print_table(rows, line_between_rows=True):
+    print(format_table(rows, line_between_rows))
+
+
+def format_table(rows, line_between_rows=True):
     """
     Example Output
     ┌──────┬─────────────┬────┬───────┐
@@ -52,28 +384,62 @@ def pretty_print_table(rows, line_between_rows=True):
     │ 8    │ medium      │ 3  │ zebra │
     └──────┴─────────────┴────┴───────┘
     """
+    return '\n'.join(iter_table_lines(rows, sample=None, line_between_rows=line_between_rows))
+
+
+def truncate(text, width):
+    return text if len(text) <= width else text[:width - 1] + '…'
+
+
+def iter_table_lines(rows, caps=None, sample=WIDTH_SAMPLE, line_between_rows=True):
+    """
+    Yields the lines of a table (see format_table) without building it in memory.
+
+    Column widths come from the first sample rows (all rows when sample is
+    None), limited to caps; longer cells further down are cut to fit.
+    """
+    rows = iter(rows)
+    head = list(rows) if sample is None else list(islice(rows, sample))
+    if not head:
+        return
 
     # find the max length of each column
-    max_col_lens = list(map(max, zip(*[(len(str(cell)) for cell in row) for row in rows])))
+    max_col_lens = list(map(max, zip(*[(len(str(cell)) for cell in row) for row in head])))
+    if caps:
+        max_col_lens = [min(length, cap) for length, cap in zip(max_col_lens, caps)]
 
-    # print the table's top border
-    print('┌' + '┬'.join('─' * (n + 2) for n in max_col_lens) + '┐')
+    # the table's top border
+    yield '┌' + '┬'.join('─' * (n + 2) for n in max_col_lens) + '┐'
 
     rows_separator = '├' + '┼'.join('─' * (n + 2) for n in max_col_lens) + '┤'
 
     row_fstring = ' │ '.join("{: <%s}" % n for n in max_col_lens)
 
-    for i, row in enumerate(rows):
-        print('│', row_fstring.format(*map(str, row)), '│')
+    for i, row in enumerate(chain(head, rows)):
+        if line_between_rows and i:
+            yield rows_separator
+        cells = (truncate(str(cell), n) for cell, n in zip(row, max_col_lens))
+        yield '│ ' + row_fstring.format(*cells) + ' │'
+
+    # the table's bottom border
+    yield '└' + '┴'.join('─' * (n + 2) for n in max_col_lens) + '┘'
 
-        if line_between_rows and i < len(rows) - 1:
-            print(rows_separator)
 
-    # print the table's bottom border
-    print('└' + '┴'.join('─' * (n + 2) for n in max_col_lens) + '┘')
+def write_lines(lines, out=None, chunk=WRITE_ROWS * 2):
+    """Writes lines to out (stdout by default) with one write call per chunk of lines."""
+    out = out or sys.stdout
+    lines = iter(lines)
+    while True:
+        block = list(islice(lines, chunk))
+        if not block:
+            break
+        out.write('\n'.join(block) + '\n')
 
 
 def print_app_intro():
+    # colorama is only needed for the banner, so it is not imported at startup
+    import colorama
+
     colorama.init()
     print(colorama.Fore.GREEN + colorama.Style.BRIGHT + '''
  █████╗ ███████╗███████╗██╗███████╗████████╗ █████╗ ███╗   ██╗████████╗    ██╗  ██╗
@@ -0,0 +1,259 @@
+from assistant_x.indexes import paused_gc
+from assistant_x.models import MAX_NOTES, MAX_PHONES, Address, Birthday, Email, Note, Phone, Record
+from assistant_x.validation import validate_columns
+import csv
+import os
+import re
+import sys
+
+
+# Records are added to the book in batches of this many
+BATCH_SIZE = 10000
+
+# Row errors listed by the import command, the rest are only counted
+MAX_REPORTED_ERRORS = 20
+
+VCARD_EXTENSIONS = ('.vcf', '.vcard')
+
+# CSV header names accepted for every field, compared in lower case
+CSV_COLUMNS = {
+    'name': 'name',
+    'phone': 'phones',
+    'phones': 'phones',
+    'phone numbers': 'phones',
+    'birthday': 'birthday',
+    'address': 'address',
+    'email': 'email',
+    'note': 'notes',
+    'notes': 'notes',
+}
+
+PHONE_SEPARATORS = re.compile(r'[\s().-]')
+# Components of structured vCard values (N, ADR) are separated by unescaped semicolons
+VCARD_COMPONENTS = re.compile(r'(?<!\\);')
+LIST_SEPARATORS = re.compile(r'[;,]')
+
+
+def read_csv(file):
+    """
+    Yields the line number and fields of every row of a CSV file.
+
+    The first row names the columns (see CSV_COLUMNS); unknown columns are ignored.
+    Several phones in one cell are separated by ";" or ",", several notes by line breaks.
+    """
+    reader = csv.reader(file)
+    header = next(reader, None)
+    if header is None:
+        return
+    columns = [(index, CSV_COLUMNS.get(column.strip().lower())) for index, column in enumerate(header)]
+    columns = [(index, column) for index, column in columns if column is not None]
+    if not any(column == 'name' for _, column in columns):
+        raise ValueError("The first row of a CSV file must name the columns, including a name column")
+
+    for row in reader:
+        fields = {'phones': [], 'notes': []}
+        for index, column in columns:
+            value = row[index].strip() if index < len(row) else ''
+            if not value:
+                continue
+            if column == 'phones':
+                fields['phones'] += [phone for phone in LIST_SEPARATORS.split(value) if phone.strip()]
+            elif column == 'notes':
+                fields['notes'] += [note for note in value.splitlines() if note.strip()]
+            else:
+                fields[column] = value
+        if len(fields) > 2 or fields['phones'] or fields['notes']:
+            yield reader.line_num, fields
+
+
+def _unfold(file):
+    # vCard lines may be folded: a line starting with a space or a tab continues the previous one
+    line_number, current = 0, None
+    for number, line in enumerate(file, 1):
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield line_number, current
+        line_number, current = number, line
+    if current is not None:
+        yield line_number, current
+
+
+def _unescape(value):
+    return re.sub(r'\\(.)', lambda match: '\n' if match.group(1) in 'nN' else match.group(1), value)
+
+
+def _vcard_birthday(value):
+    # vCards write dates as YYYY-MM-DD or YYYYMMDD, the book reads DD.MM.YYYY
+    digits = value.replace('-', '')
+    if len(digits) == 8 and digits.isdigit():
+        return f"{digits[6:8]}.{digits[4:6]}.{digits[0:4]}"
+    return value
+
+
+def read_vcard(file):
+    """
+    Yields the line number and fields of every card of a vCard file.
+
+    FN (or N when FN is missing), TEL, BDAY, ADR, EMAIL and NOTE are read; only
+    the first address and email of a card are kept.
+    """
+    fields = None
+    start = 0
+    for line_number, line in _unfold(file):
+        if not line.strip():
+            continue
+        name, _, value = line.partition(':')
+        # Drop the group ("item1.TEL") and the parameters ("TEL;TYPE=cell")
+        name = name.split(';', 1)[0].rpartition('.')[2].upper()
+
+        if name == 'BEGIN' and value.strip().upper() == 'VCARD':
+            fields, start = {'phones': [], 'notes': []}, line_number
+        elif fields is None:
+            continue
+        elif name == 'END':
+            yield start, fields
+            fields = None
+        elif name == 'FN':
+            fields['name'] = _unescape(value).strip()
+        elif name == 'N' and 'name' not in fields:
+            parts = [_unescape(part).strip() for part in VCARD_COMPONENTS.split(value)]
+            fields['name'] = ' '.join(part for part in parts[1:2] + parts[:1] if part)
+        elif name == 'TEL':
+            fields['phones'].append(value.rpartition(':')[2] if value.startswith('tel:') else value)
+        elif name == 'BDAY':
+            fields['birthday'] = _vcard_birthday(value.strip())
+        elif name == 'ADR' and 'address' not in fields:
+            parts = [_unescape(part).strip() for part in VCARD_COMPONENTS.split(value)]
+            fields['address'] = ', '.join(part for part in parts if part)
+        elif name == 'EMAIL' and 'email' not in fields:
+            fields['email'] = value.strip()
+        elif name == 'NOTE':
+            fields['notes'].append(_unescape(value))
+
+
+def build_records(rows):
+    """
+    Creates records from a batch of imported rows, given as (line number, fields) pairs.
+
+    The phones, emails and birthdays of the whole batch are validated together
+    by validate_columns, with the same rules as fields entered by hand.
+
+    Yields the line number, the record and None for every valid row, and the
+    line number, None and the reason for every invalid one.
+    """
+    phones = [PHONE_SEPARATORS.sub('', phone) for _, fields in rows for phone in fields['phones']]
+    emails = [fields['email'] for _, fields in rows if 'email' in fields]
+    birthdays = [fields['birthday'] for _, fields in rows if 'birthday' in fields]
+    verdicts = validate_columns({'phone': phones, 'email': emails, 'birthday': birthdays})
+    numbers = iter(verdicts['phone'])
+    valid_emails = iter(verdicts['email'])
+    ordinals = iter(verdicts['birthday'])
+
+    for line_number, fields in rows:
+        # Verdicts are consumed for every row, valid or not, to stay aligned with the rows
+        row_numbers = [next(numbers) for _ in fields['phones']]
+        email = next(valid_emails) if 'email' in fields else None
+        ordinal = next(ordinals) if 'birthday' in fields else None
+
+        if not fields.get('name'):
+            yield line_number, None, "Missing name"
+        elif None in row_numbers:
+            yield line_number, None, "Invalid phone number"
+        elif len(row_numbers) > MAX_PHONES:
+            yield line_number, None, f"More than {MAX_PHONES} phone numbers"
+        elif len(fields['notes']) > MAX_NOTES:
+            yield line_number, None, f"More than {MAX_NOTES} notes"
+        elif 'birthday' in fields and ordinal is None:
+            yield line_number, None, "Invalid birthday format. Use DD.MM.YYYY"
+        elif 'email' in fields and email is None:
+            yield line_number, None, f"Invalid email address {fields['email']}"
+        else:
+            record = Record(fields['name'])
+            record.phones.extend(Phone.from_number(number) for number in row_numbers)
+            if ordinal is not None:
+                record.birthday = Birthday.from_ordinal(ordinal)
+            if 'address' in fields:
+                record.address = Address(fields['address'])
+            if email is not None:
+                record.email = Email.from_valid(email)
+            record.notes.extend(Note(note) for note in fields['notes'])
+            yield line_number, record, None
+
+
+def read_contacts(path):
+    """
+    Yields the line number and fields of every contact of a CSV or vCard file,
+    chosen by the extension of the file.
+    """
+    reader = read_vcard if path.lower().endswith(VCARD_EXTENSIONS) else read_csv
+    with open(path, newline='', encoding='utf-8-sig') as file:
+        yield from reader(file)
+
+
+def import_contacts(path, book, batch_size=BATCH_SIZE):
+    """
+    Adds the contacts of a CSV or vCard file to the book.
+
+    The file is read as a stream and validated and added in batches, so the
+    file is never held in memory. Rows that fail validation, lack a name or
+    name a contact that already exists are skipped.
+
+    Returns the number of imported contacts and a list of (line number, reason)
+    for every skipped row.
+    """
+    imported = 0
+    errors = []
+    rows = []
+
+    def add_batch():
+        nonlocal imported
+        for line_number, record, error in build_records(rows):
+            if record is None:
+                errors.append((line_number, error))
+                continue
+            name = record.name.value
+            if name in book:
+                errors.append((line_number, f"Contact {name} already exists"))
+                continue
+            book[name] = record
+            imported += 1
+        rows.clear()
+
+    with paused_gc():
+        for row in read_contacts(path):
+            rows.append(row)
+            if len(rows) >= batch_size:
+                add_batch()
+        add_batch()
+
+    return imported, errors
+
+
+def format_import_report(path, imported, errors):
+    lines = [f"Imported {imported} contacts from {path}"]
+    if errors:
+        lines.append(f"Skipped {len(errors)} rows:")
+        lines.extend(f"  line {line_number}: {reason}" for line_number, reason in errors[:MAX_REPORTED_ERRORS])
+        if len(errors) > MAX_REPORTED_ERRORS:
+            lines.append(f"  ... and {len(errors) - MAX_REPORTED_ERRORS} more")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """Entry point of the assistant_x-import command, imports the given files into the address book."""
+    from assistant_x.handlers import get_address_book, import_handler
+    from assistant_x.storage import get_persister
+
+    paths = sys.argv[1:] if argv is None else argv
+    if not paths:
+        print("Usage: assistant_x-import <file.csv | file.vcf> ...")
+        return 2
+
+    book = get_address_book()
+    for path in paths:
+        print(import_handler(['import', path], book=book))
+    get_persister().close()
+    return 0 if all(os.path.isfile(path) for path in paths) else 1
@@ -0,0 +1,883 @@
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import bisect
+import datetime
+import gc
+import heapq
+import itertools
+import math
+import re
+import time
+
+
+@contextmanager
+def paused_gc():
+    """
+    Pauses the cyclic garbage collector while many long-lived objects are created.
+
+    Building an index allocates millions of containers, and every collection run
+    in the middle of that would walk all of them again.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class Index:
+    """
+    Base class for the search indexes kept by AddressBook.
+
+    An index is built the first time it is needed and from then on updated by
+    the book whenever a record is added, changed or deleted, so a query never
+    has to walk the whole book.
+
+    Attributes:
+        fields (tuple): Record fields the index depends on; changes to other fields are ignored.
+        order (dict): Position of every indexed name, used to return results in book order.
+
+    Methods:
+        build(book: AddressBook): Indexes every record of the book.
+        add(record: Record): Indexes a record.
+        discard(name: str): Removes a record from the index.
+        update(record: Record): Re-indexes a record after it changed.
+        sort(names): Sorts names in the order their records were added.
+    """
+
+    fields = ()
+
+    def __init__(self):
+        self.order = {}
+        self.counter = itertools.count()
+
+    def __getstate__(self):
+        # Kept on disk by FileStorage (see LazyRecords.load_index); the counter goes on after the last position
+        state = self.__dict__.copy()
+        state['counter'] = max(self.order.values(), default=-1) + 1
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.counter = itertools.count(state['counter'])
+
+    def build(self, book):
+        for record in book.iter_contacts():
+            self.add(record)
+
+    def add(self, record):
+        self._insert(record.name.value, record)
+
+    def _insert(self, name, record):
+        if name not in self.order:
+            self.order[name] = next(self.counter)
+        self._add(name, record)
+
+    def discard(self, name):
+        if self.order.pop(name, None) is not None:
+            self._discard(name)
+
+    def update(self, record):
+        name = record.name.value
+        if name in self.order:
+            self._discard(name)
+        self.add(record)
+
+    def sort(self, names):
+        return sorted(names, key=self.order.__getitem__)
+
+    def _add(self, name, record):
+        raise NotImplementedError
+
+    def _discard(self, name):
+        raise NotImplementedError
+
+
+class NGramIndex(Index):
+    """
+    Substring index: postings of every n-gram of the indexed keys.
+
+    A query is answered by intersecting the posting lists of its n-grams and
+    checking the keys of the remaining candidates only. Queries shorter than
+    an n-gram match too many records for postings to help; they are checked
+    against the stored keys of every record.
+
+    Attributes:
+        size (int): Length of the n-grams.
+        keys (dict): Indexed key of every record, by name.
+        postings (dict): Names of the records containing each n-gram.
+
+    Methods:
+        key_of(name: str, record: Record): Returns the text to index for a record.
+        search(query: str): Returns the names whose key contains query, in book order.
+    """
+
+    def __init__(self, size=3):
+        super().__init__()
+        self.size = size
+        self.keys = {}
+        self.postings = defaultdict(set)
+
+    def key_of(self, name, record):
+        raise NotImplementedError
+
+    def _grams(self, key):
+        return {key[i:i + self.size] for i in range(len(key) - self.size + 1)}
+
+    def _add(self, name, record):
+        key = self.key_of(name, record)
+        self.keys[name] = key
+        postings = self.postings
+        for gram in self._grams(key):
+            postings[gram].add(name)
+
+    def _discard(self, name):
+        self._remove_grams(name, self._grams(self.keys.pop(name)))
+
+    def _remove_grams(self, name, grams):
+        for gram in grams:
+            names = self.postings[gram]
+            names.discard(name)
+            if not names:
+                del self.postings[gram]
+
+    def update(self, record):
+        name = record.name.value
+        if name not in self.order:
+            self.add(record)
+            return
+
+        # Only the n-grams that differ are touched, and the name keeps its place in self.keys
+        old_grams = self._grams(self.keys[name])
+        key = self.key_of(name, record)
+        new_grams = self._grams(key)
+        self._remove_grams(name, old_grams - new_grams)
+        for gram in new_grams - old_grams:
+            self.postings[gram].add(name)
+        self.keys[name] = key
+
+    def search(self, query):
+        if len(query) < self.size:
+            # self.keys is already in book order
+            return [name for name, key in self.keys.items() if query in key]
+
+        grams = self._grams(query)
+        if any(gram not in self.postings for gram in grams):
+            return []
+        postings = sorted((self.postings[gram] for gram in grams), key=len)
+        candidates = postings[0].intersection(*postings[1:])
+        return self.sort(name for name in candidates if query in self.keys[name])
+
+
+class PhoneIndex(NGramIndex):
+    """
+    Index of the digits of every phone number, for substring search by phone.
+    """
+
+    fields = ('phones',)
+
+    def key_of(self, name, record):
+        # The separator keeps matches from running across two numbers
+        return '\n'.join(phone.value for phone in record.phones)
+
+
+def rank_names(names, query):
+    """
+    Orders names by how well they match query: exact match, then prefix match,
+    then a match at the start of a word, then any other match.
+    Shorter names go first within each group; the sort is stable.
+    """
+    query = query.casefold()
+
+    def quality(name):
+        key = name.casefold()
+        if key == query:
+            group = 0
+        elif key.startswith(query):
+            group = 1
+        elif f' {query}' in f' {key}':
+            group = 2
+        else:
+            group = 3
+        return group, len(key)
+
+    return sorted(names, key=quality)
+
+
+class NameIndex(NGramIndex):
+    """
+    Index of casefolded contact names, for infix queries through the trigram
+    postings of NGramIndex.
+    """
+
+    def build(self, book):
+        # Only the names are needed, so records of a lazily loaded book stay on disk
+        for name in book.data:
+            self._insert(name, None)
+
+    def key_of(self, name, record):
+        return name.casefold()
+
+    def update(self, record):
+        # The name is the key of the record, so it never changes
+        if record.name.value not in self.order:
+            self.add(record)
+
+
+class PrefixIndex(Index):
+    """
+    Sorted list of the casefolded contact names, for "starts with" queries and
+    completion: the names starting with a prefix are a range of the list. Kept
+    apart from NameIndex, so completing a name does not wait for the trigrams
+    of every name to be built.
+
+    Attributes:
+        entries (list): (casefolded name, name) pairs, sorted.
+
+    Methods:
+        starts_with(prefix: str): Returns the names starting with prefix, in book order.
+        complete(prefix: str, limit: int): Returns up to limit names starting with prefix, sorted.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.entries = []
+
+    def build(self, book):
+        for name in book.data:
+            self.order[name] = next(self.counter)
+        self.entries = sorted((name.casefold(), name) for name in self.order)
+
+    def _add(self, name, record):
+        bisect.insort(self.entries, (name.casefold(), name))
+
+    def _discard(self, name):
+        del self.entries[bisect.bisect_left(self.entries, (name.casefold(), name))]
+
+    def update(self, record):
+        # The name is the key of the record, so it never changes
+        if record.name.value not in self.order:
+            self.add(record)
+
+    def _starting(self, prefix):
+        prefix = prefix.casefold()
+        entries = self.entries
+        for position in range(bisect.bisect_left(entries, (prefix,)), len(entries)):
+            key, name = entries[position]
+            if not key.startswith(prefix):
+                break
+            yield name
+
+    def starts_with(self, prefix):
+        return self.sort(self._starting(prefix))
+
+    def complete(self, prefix, limit):
+        # Only limit + 1 names are taken, so short prefixes stay cheap;
+        # when more names match, none are offered until the prefix gets longer
+        names = list(itertools.islice(self._starting(prefix), limit + 1))
+        if len(names) > limit:
+            return []
+        return sorted(names)
+
+
+def tokenize(text):
+    return re.findall(r'\w+', text.casefold())
+
+
+class NoteIndex(Index):
+    """
+    Inverted index over the words of all notes, ranked with BM25.
+
+    Every note is a document identified by the contact name and the note
+    index. A change to the notes of a record re-indexes the notes of that
+    record only.
+
+    Attributes:
+        postings (dict): Term frequency of each word, by document, by word.
+        lengths (dict): Number of words of each document.
+        documents (dict): Documents of every record, by name.
+
+    Methods:
+        search(terms: str, limit: int): Returns (score, name, note index) of the best matching notes.
+    """
+
+    fields = ('notes',)
+
+    # BM25 parameters
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        super().__init__()
+        self.postings = defaultdict(dict)
+        self.lengths = {}
+        self.total_length = 0
+        self.documents = {}
+
+    def _add(self, name, record):
+        documents = []
+        for note_index, note in enumerate(record.notes):
+            document = (name, note_index)
+            words = tokenize(note.value)
+            for word, frequency in Counter(words).items():
+                self.postings[word][document] = frequency
+            self.lengths[document] = len(words)
+            self.total_length += len(words)
+            documents.append((document, set(words)))
+        self.documents[name] = documents
+
+    def _discard(self, name):
+        for document, words in self.documents.pop(name):
+            for word in words:
+                frequencies = self.postings[word]
+                del frequencies[document]
+                if not frequencies:
+                    del self.postings[word]
+            self.total_length -= self.lengths.pop(document)
+
+    def search(self, terms, limit=None):
+        if not self.lengths:
+            return []
+        count = len(self.lengths)
+        average_length = self.total_length / count or 1
+
+        scores = defaultdict(float)
+        for word in set(tokenize(terms)):
+            frequencies = self.postings.get(word)
+            if not frequencies:
+                continue
+            idf = math.log(1 + (count - len(frequencies) + 0.5) / (len(frequencies) + 0.5))
+            for document, frequency in frequencies.items():
+                norm = self.K1 * (1 - self.B + self.B * self.lengths[document] / average_length)
+                scores[document] += idf * frequency * (self.K1 + 1) / (frequency + norm)
+
+        hits = ((score, name, note_index) for (name, note_index), score in scores.items())
+        if limit is not None:
+            return heapq.nlargest(limit, hits, key=lambda hit: hit[0])
+        return sorted(hits, key=lambda hit: hit[0], reverse=True)
+
+
+def edit_distance(first, second):
+    """
+    Levenshtein distance, computed with the bit-parallel algorithm of Myers and Hyyrö.
+
+    Every character of the longer string costs a handful of integer operations,
+    instead of a full row of the dynamic programming table.
+    """
+    # What both start and end with costs nothing, and often leaves little to compare
+    shortest = min(len(first), len(second))
+    start = 0
+    while start < shortest and first[start] == second[start]:
+        start += 1
+    end = 0
+    while end < shortest - start and first[-1 - end] == second[-1 - end]:
+        end += 1
+    first = first[start:len(first) - end]
+    second = second[start:len(second) - end]
+
+    if len(first) < len(second):
+        first, second = second, first
+    if not second:
+        return len(first)
+
+    masks = {}
+    for i, char in enumerate(second):
+        masks[char] = masks.get(char, 0) | (1 << i)
+    full = (1 << len(second)) - 1
+    last = 1 << (len(second) - 1)
+    positive, negative, distance = full, 0, len(second)
+
+    for char in first:
+        match = masks.get(char, 0)
+        vertical = match | negative
+        horizontal = (((match & positive) + positive) ^ positive) | match
+        horizontal_positive = negative | ~(horizontal | positive)
+        horizontal_negative = positive & horizontal
+        if horizontal_positive & last:
+            distance += 1
+        elif horizontal_negative & last:
+            distance -= 1
+        horizontal_positive = (horizontal_positive << 1) | 1
+        horizontal_negative <<= 1
+        positive = (horizontal_negative | ~(vertical | horizontal_positive)) & full
+        negative = horizontal_positive & vertical
+    return distance
+
+
+def letter_mask(word):
+    """
+    Bit set of the letters of word, folded into 64 bits. Every bit set for one
+    word and not for another stands for a letter that takes an edit to turn
+    the first word into the second.
+    """
+    mask = 0
+    for char in word:
+        mask |= 1 << (ord(char) & 63)
+    return mask
+
+
+def similar_names(query, names, max_distance=2, deadline=None):
+    """
+    (distance, name) of the names within max_distance edits of query, closest
+    first, checked one by one without an index. Given a time.perf_counter()
+    deadline, only the names checked by then are.
+    """
+    query = query.casefold()
+    hits = []
+    for position, name in enumerate(names):
+        if deadline is not None and not position % 1024 and time.perf_counter() > deadline:
+            break
+        if abs(len(name) - len(query)) > max_distance:
+            continue
+        distance = edit_distance(query, name.casefold())
+        if distance <= max_distance:
+            hits.append((distance, position, name))
+    return [(distance, name) for distance, _, name in sorted(hits)]
+
+
+class FuzzyIndex(Index):
+    """
+    Typo-tolerant name lookup with a symmetric deletion index over the words of the names.
+
+    Every distinct word of the casefolded names is stored under all the strings
+    that can be made from its first PREFIX characters by deleting up to
+    MAX_DISTANCE of them. Two words within MAX_DISTANCE edits of each other
+    always share one of those strings, so the words close to a query word are
+    found by looking up the deletions of the query word alone. A string shared
+    by more than BUCKET words, e.g. the common start of Surname1 to Surname99999,
+    tells them apart too poorly to be worth checking and is skipped; the words
+    it stands for are then only found among the names that the other query
+    words leave, when there are at most SCANNED of them.
+
+    The words of a name within MAX_DISTANCE edits of a query of several words
+    are that close to the query words, and their distances add up to at most
+    MAX_DISTANCE. So the candidates are taken for every way of spreading the
+    distance over the query words, as the names holding a word at most that
+    far from each query word. Words that must be spelled right are plain
+    lookups and are taken first: a way of spreading that finds nothing for one
+    of them is given up at once, and one that finds a rare word has only a few
+    names left to check. Names are kept by the length of their key as well,
+    and only those of about the length of the query are candidates.
+
+    Short words are close to a great many others, so keys of up to WHOLE
+    characters are stored whole as well, and a query that only names that
+    short can be close to is looked up whole.
+
+    A query of one word may also be a name of two words with the space left out
+    or mistyped. That costs an edit already, so the query is split in two at
+    every position, and the names with one part spelled right and the other
+    close to it are checked too.
+
+    Attributes:
+        keys (dict): Casefolded key of every name.
+        variants (dict): Words stored under every deletion variant.
+        postings (dict): Names holding every word, by the length of their key.
+        masks (dict): Letters of every word, see letter_mask.
+
+    Methods:
+        search(query: str, max_distance: int, deadline: float): Returns (distance, name) of the names
+            within max_distance edits, of those found by the time.perf_counter() deadline if given.
+    """
+
+    MAX_DISTANCE = 2
+    PREFIX = 6
+    # Words sharing a deletion variant above which the variant is not looked up
+    BUCKET = 256
+    # Candidate names whose words are checked one by one in place of skipped variants
+    SCANNED = 512
+    # Candidates few enough to check without narrowing them down by the other query words
+    CHECKED = 64
+    # Keys stored whole besides their words, short enough for their words to be close to too many
+    WHOLE = PREFIX + MAX_DISTANCE
+
+    def __init__(self):
+        super().__init__()
+        self.keys = {}
+        self.variants = {}
+        self.postings = {}
+        self.masks = {}
+
+    def build(self, book):
+        for name in book.data:
+            self._insert(name, None)
+
+    def update(self, record):
+        # The name is the key of the record, so it never changes
+        if record.name.value not in self.order:
+            self.add(record)
+
+    def _terms(self, key):
+        # The words stored for a key, and the key itself when it is short
+        terms = set(key.split()) or {key}
+        if len(key) <= self.WHOLE:
+            terms.add(key)
+        return terms
+
+    def _deletions(self, word, max_distance):
+        variants = {word[:self.PREFIX]}
+        frontier = variants
+        for _ in range(max_distance):
+            frontier = {part[:i] + part[i + 1:] for part in frontier for i in range(len(part))}
+            variants |= frontier
+        return variants
+
+    def _add(self, name, record):
+        key = name.casefold()
+        self.keys[name] = key
+        for word in self._terms(key):
+            by_length = self.postings.get(word)
+            if by_length is None:
+                by_length = self.postings[word] = {}
+                self.masks[word] = letter_mask(word)
+                for variant in self._deletions(word, self.MAX_DISTANCE):
+                    self.variants.setdefault(variant, set()).add(word)
+            by_length.setdefault(len(key), set()).add(name)
+
+    def _discard(self, name):
+        key = self.keys.pop(name)
+        for word in self._terms(key):
+            by_length = self.postings[word]
+            names = by_length[len(key)]
+            names.discard(name)
+            if not names:
+                del by_length[len(key)]
+            if by_length:
+                continue
+            del self.postings[word]
+            del self.masks[word]
+            for variant in self._deletions(word, self.MAX_DISTANCE):
+                words = self.variants[variant]
+                words.discard(word)
+                if not words:
+                    del self.variants[variant]
+
+    def _close_words(self, query_word, max_distance, among=None):
+        # Indexed words within max_distance edits of query_word; given among, only
+        # the words of these names, which is cheaper to check than the distance
+        close = {query_word} if query_word in self.postings else set()
+        if not max_distance:
+            return close
+        words = set()
+        skipped = False
+        for variant in self._deletions(query_word, max_distance):
+            shared = self.variants.get(variant)
+            if shared is None:
+                continue
+            if len(shared) > self.BUCKET:
+                skipped = True
+            else:
+                words |= shared
+        if skipped and among is not None and len(among) <= self.SCANNED:
+            # The words behind a skipped variant are found among the names instead
+            for name in among:
+                words.update(self.keys[name].split())
+
+        query_mask = letter_mask(query_word)
+        for word in words - close:
+            # Short variants are shared by many words, most of them too far off; a letter missing
+            # from either word takes an edit, which rules most out before the distance is computed
+            if abs(len(word) - len(query_word)) > max_distance:
+                continue
+            mask = self.masks[word]
+            if bin(mask & ~query_mask).count('1') > max_distance or bin(query_mask & ~mask).count('1') > max_distance:
+                continue
+            if among is not None and all(among.isdisjoint(names) for names in self.postings[word].values()):
+                continue
+            if edit_distance(query_word, word) <= max_distance:
+                close.add(word)
+        return close
+
+    def _skips(self, query_word, max_distance):
+        # Whether _close_words skips a variant of query_word
+        return any(
+            len(self.variants.get(variant, ())) > self.BUCKET for variant in self._deletions(query_word, max_distance)
+        )
+
+    def _holding(self, words, lengths):
+        # Names holding one of words, with a key of one of lengths
+        names = set()
+        for word in words:
+            by_length = self.postings[word]
+            for length in lengths:
+                found = by_length.get(length)
+                if found:
+                    names |= found
+        return names
+
+    @staticmethod
+    def _spreads(count, total):
+        # Every way of spreading total edits over count words, e.g. (2, 0), (1, 1) and (0, 2)
+        if count == 1:
+            yield (total,)
+            return
+        for first in range(total, -1, -1):
+            for rest in FuzzyIndex._spreads(count - 1, total - first):
+                yield (first,) + rest
+
+    def _candidates(self, query_words, lengths, max_distance, found, deadline):
+        # Names holding words close to all query words, for every way of spreading max_distance;
+        # found keeps the names of (query word, distance) across calls
+        names = set()
+        for distances in self._spreads(len(query_words), max_distance):
+            if deadline is not None and time.perf_counter() > deadline:
+                break
+            # Exact words first, then the closest and longest, which narrow the names down most;
+            # words that skip variants only once there are candidates to check their words in
+            terms = sorted(
+                zip(distances, query_words),
+                key=lambda term: (term[0], term[0] > 0 and self._skips(term[1], term[0]), -len(term[1])),
+            )
+            candidates = None
+            for distance, query_word in terms:
+                if len(query_word) < distance:
+                    # The word and a space can be typos altogether
+                    continue
+                if candidates is None:
+                    candidates = found.get((query_word, distance))
+                    if candidates is None:
+                        candidates = found[query_word, distance] = self._holding(
+                            self._close_words(query_word, distance), lengths
+                        )
+                elif len(candidates) <= self.CHECKED:
+                    break
+                else:
+                    close = self._close_words(query_word, distance, candidates)
+                    candidates = candidates & self._holding(close, lengths)
+                if not candidates:
+                    break
+            if candidates:
+                names |= candidates
+        return names
+
+    def search(self, query, max_distance=MAX_DISTANCE, deadline=None):
+        max_distance = min(max_distance, self.MAX_DISTANCE)
+        query = query.casefold()
+        lengths = range(len(query) - max_distance, len(query) + max_distance + 1)
+        if len(query) + max_distance <= self.WHOLE:
+            # Every name that close is stored whole as well
+            names = self._holding(self._close_words(query, max_distance), lengths)
+            return self._sorted(self._verify(query, names, max_distance))
+
+        query_words = query.split()
+        found = {}
+        if len(query_words) > 1:
+            names = self._candidates(query_words, lengths, max_distance, found, deadline)
+        elif not max_distance:
+            names = self._holding(self._close_words(query, 0), lengths)
+        else:
+            names = self._holding(self._close_words(query, max_distance), lengths)
+            # Two words with the space left out, or with another character in its place
+            for split in range(1, len(query)):
+                if deadline is not None and time.perf_counter() > deadline:
+                    break
+                for rest in (query[split:], query[split + 1:]):
+                    if rest:
+                        names |= self._candidates((query[:split], rest), lengths, max_distance - 1, found, deadline)
+        return self._sorted(self._verify(query, names, max_distance))
+
+    def _sorted(self, hits):
+        return sorted(hits, key=lambda hit: (hit[0], self.order[hit[1]]))
+
+    def _verify(self, query, names, max_distance):
+        hits = []
+        for name in names:
+            distance = edit_distance(query, self.keys[name])
+            if distance <= max_distance:
+                hits.append((distance, name))
+        return hits
+
+
+class EmailIndex(Index):
+    """
+    Index of the casefolded email addresses and their domains.
+
+    Attributes:
+        emails (dict): Indexed email of every name.
+        by_email (dict): Names having each email.
+        by_domain (dict): Names having an email in each domain.
+
+    Methods:
+        search(email: str): Returns the names with exactly this email, in book order.
+        search_domain(domain: str): Returns the names with an email in this domain, in book order.
+    """
+
+    fields = ('email',)
+
+    def __init__(self):
+        super().__init__()
+        self.emails = {}
+        self.by_email = defaultdict(set)
+        self.by_domain = defaultdict(set)
+
+    def _add(self, name, record):
+        if not record.email or not record.email.value:
+            return
+        email = record.email.value.casefold()
+        self.emails[name] = email
+        self.by_email[email].add(name)
+        self.by_domain[email.rpartition('@')[2]].add(name)
+
+    def _discard(self, name):
+        email = self.emails.pop(name, None)
+        if email is None:
+            return
+        for postings, key in ((self.by_email, email), (self.by_domain, email.rpartition('@')[2])):
+            postings[key].discard(name)
+            if not postings[key]:
+                del postings[key]
+
+    def search(self, email):
+        return self.sort(self.by_email.get(email.casefold(), ()))
+
+    def search_domain(self, domain):
+        return self.sort(self.by_domain.get(domain.casefold().lstrip('@'), ()))
+
+
+class AddressIndex(Index):
+    """
+    Index of the words of every address, e.g. street and city names.
+
+    Attributes:
+        tokens (dict): Words of the address of every name.
+        postings (dict): Names whose address contains each word.
+
+    Methods:
+        search(query: str): Returns the names whose address has all words of query, in book order.
+    """
+
+    fields = ('address',)
+
+    def __init__(self):
+        super().__init__()
+        self.tokens = {}
+        self.postings = defaultdict(set)
+
+    def _add(self, name, record):
+        if not record.address:
+            return
+        tokens = set(tokenize(record.address.value))
+        self.tokens[name] = tokens
+        for token in tokens:
+            self.postings[token].add(name)
+
+    def _discard(self, name):
+        for token in self.tokens.pop(name, ()):
+            names = self.postings[token]
+            names.discard(name)
+            if not names:
+                del self.postings[token]
+
+    def search(self, query):
+        tokens = tokenize(query)
+        if not tokens or any(token not in self.postings for token in tokens):
+            return []
+        postings = sorted((self.postings[token] for token in tokens), key=len)
+        return self.sort(postings[0].intersection(*postings[1:]))
+
+
+def day_of_year(date):
+    """
+    Day of the year of date, counted in a leap year so that every month and day,
+    including February 29, has its own number from 1 to 366.
+    """
+    return datetime.date(2000, date.month, date.day).timetuple().tm_yday
+
+
+class BirthdayIndex(Index):
+    """
+    Sorted list of the birthdays of the book by day of the year.
+
+    Attributes:
+        days (dict): Day of the year of the birthday of every name.
+        entries (list): (day of the year, name) pairs, sorted.
+
+    Methods:
+        between(first: int, last: int): Returns the names with a birthday from day first to day last.
+        upcoming(today: date, days: int): Returns the names that may have a birthday in the next days.
+    """
+
+    fields = ('birthday',)
+
+    def __init__(self):
+        super().__init__()
+        self.days = {}
+        self.entries = []
+
+    def build(self, book):
+        for record in book.iter_contacts():
+            name = record.name.value
+            self.order[name] = next(self.counter)
+            if record.birthday:
+                self.days[name] = day_of_year(record.birthday.value)
+        self.entries = sorted((day, name) for name, day in self.days.items())
+
+    def _add(self, name, record):
+        if not record.birthday:
+            return
+        day = day_of_year(record.birthday.value)
+        self.days[name] = day
+        bisect.insort(self.entries, (day, name))
+
+    def _discard(self, name):
+        day = self.days.pop(name, None)
+        if day is None:
+            return
+        del self.entries[bisect.bisect_left(self.entries, (day, name))]
+
+    def between(self, first, last):
+        start = bisect.bisect_left(self.entries, (first,))
+        end = bisect.bisect_left(self.entries, (last + 1,))
+        return [name for _, name in self.entries[start:end]]
+
+    def upcoming(self, today, days):
+        if days < 0:
+            return []
+        end = today + datetime.timedelta(days=days)
+        first = day_of_year(today)
+        # One day more than asked for: in other than leap years February 29
+        # birthdays are celebrated on February 28
+        last = day_of_year(end) + 1
+        if end.year == today.year:
+            return self.between(first, last)
+        if days >= 365 or last >= first:
+            return [name for _, name in self.entries]
+        return self.between(first, 366) + self.between(1, last)
+
+
+# Prefixes of the find queries answered from EmailIndex and AddressIndex
+FIELD_QUERIES = ('email', 'domain', 'address', 'city')
+
+
+def split_field_query(query):
+    """
+    Splits "email:john@corp.com" into ("email", "john@corp.com").
+    Queries without a known field prefix come back as (None, query).
+    """
+    field, separator, value = query.partition(':')
+    if separator and field.lower() in FIELD_QUERIES:
+        return field.lower(), value
+    return None, query
+
+
+def matches(record, search_query):
+    """
+    Tells whether a record matches a find query, the way the indexes answer it
+    (see AddressBook.find_names); for records that are not indexed.
+    """
+    field, value = split_field_query(search_query)
+    if field == 'email' and not value.startswith('@'):
+        return bool(record.email and record.email.value) and record.email.value.casefold() == value.casefold()
+    if field in ('email', 'domain'):
+        if not record.email or not record.email.value:
+            return False
+        return record.email.value.casefold().rpartition('@')[2] == value.casefold().lstrip('@')
+    if field in ('address', 'city'):
+        tokens = set(tokenize(value))
+        return bool(tokens and record.address) and tokens <= set(tokenize(record.address.value))
+    if search_query.isdigit():
+        return any(search_query in phone.value for phone in record.phones)
+    if search_query.endswith('*'):
+        return record.name.value.casefold().startswith(search_query[:-1].casefold())
+    return search_query.casefold() in record.name.value.casefold()
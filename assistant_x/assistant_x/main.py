@@ -1,55 +1,305 @@
-from assistant_x.helpers import print_app_intro, print_help
-from assistant_x.handlers import *
-from assistant_x.models import *
-
-
-def main():
-    book = get_address_book()
-
-    print_app_intro()
-    print("Welcome to the Address Book Assistant X!")
-    print_help()
-
-    handlers = {
-        'add': add_handler,
-        'change-number': change_handler,
-        'find': search_handler,
-        'all': all_handler,
-        'add-birthday': add_birthday_handler,
-        'show-birthday': show_birthday_handler,
-        'birthdays-in-period': show_birthdays_in_period_handler,
-        'birthdays': show_birthdays_next_week_handler,
-        'add-address': add_address_hadler,
-        'add-email': add_email_handler,
-        "change-email": change_email_handler,
-        "change-address": change_address_handler,
-        "show-email": show_email_handler,
-        "show-address": show_address_handler,
-        "delete-contact": delete_handler,
-        'add-note': add_note_handler,
-        'edit-note': edit_note_handler,
-        'note': show_note_handler,
-        'delete-note': delete_note_handler,
-        'help': help_handler,
-        'close': close_handler,
-        'exit': close_handler,
-    }
+import time
+
+# Taken before the rest of the app is imported, for --startup-profile
+STARTED = time.perf_counter()
+
+from assistant_x.helpers import OUTPUT_FORMATS, CommandError, failure_line, print_app_intro, print_help, print_result
+from assistant_x.stats import instrument, start_profiling
+from importlib import import_module
+import argparse
+import sys
+import threading
+
+
+# Names of the command handlers; the handlers, and the models and storage
+# behind them, are imported when the book is loaded
+HANDLERS = {
+    'add': 'add_handler',
+    'change-number': 'change_handler',
+    'find': 'search_handler',
+    'all': 'all_handler',
+    'add-birthday': 'add_birthday_handler',
+    'show-birthday': 'show_birthday_handler',
+    'birthdays-in-period': 'show_birthdays_in_period_handler',
+    'birthdays': 'show_birthdays_next_week_handler',
+    'add-address': 'add_address_hadler',
+    'add-email': 'add_email_handler',
+    "change-email": 'change_email_handler',
+    "change-address": 'change_address_handler',
+    "show-email": 'show_email_handler',
+    "show-address": 'show_address_handler',
+    "delete-contact": 'delete_handler',
+    'add-note': 'add_note_handler',
+    'edit-note': 'edit_note_handler',
+    'note': 'show_note_handler',
+    'find-note': 'find_note_handler',
+    'import': 'import_handler',
+    'export': 'export_handler',
+    'delete-note': 'delete_note_handler',
+    'stats': 'stats_handler',
+    'help': 'help_handler',
+    'close': 'close_handler',
+    'exit': 'close_handler',
+}
+
+
+# Commands whose first argument is a contact name, completed with the Tab key
+NAME_COMMANDS = {
+    'change-number', 'add-birthday', 'show-birthday', 'add-address', 'add-email',
+    'change-email', 'change-address', 'show-email', 'show-address', 'delete-contact',
+    'add-note', 'edit-note', 'note', 'delete-note',
+}
+
+
+# Handlers already looked up, wrapped to be counted by the stats command
+_handlers = {}
+
+
+def get_handler(command):
+    handler = _handlers.get(command)
+    if handler is None:
+        name = HANDLERS.get(command)
+        if name is None:
+            return None
+        handler = _handlers[command] = instrument('command', command, getattr(import_module('assistant_x.handlers'), name))
+    return handler
+
+
+def dispatch(command, book):
+    handler = get_handler(command[0])
+    if handler is None:
+        return CommandError("Unknown command")
+    from assistant_x.storage import get_storage, report_conflicts
+
+    # Picks up what other assistant_x processes saved since the last command
+    report_conflicts(get_storage().refresh(book))
+    return handler(command, book=book)
+
+
+def run_command(command, book):
+    """Runs a command, replying with a CommandError instead of raising when its handler fails."""
+    try:
+        return dispatch(command, book)
+    except Exception as error:
+        return CommandError(f"{type(error).__name__}: {error}")
+
+
+def load_book(timings):
+    """Imports the handlers and loads the address book, recording how long each took in timings."""
+    started = time.perf_counter()
+    handlers = import_module('assistant_x.handlers')
+    imported = time.perf_counter()
+    book = handlers.get_address_book()
+    timings['imports'] = imported - started
+    timings['load'] = time.perf_counter() - imported
+    return book
+
+
+def report_startup(timings, book):
+    parts = [
+        f"imports {timings['imports'] * 1000:.1f} ms",
+        f"book load {timings['load'] * 1000:.1f} ms ({len(book)} contacts)",
+    ]
+    if 'banner' in timings:
+        parts.append(f"banner {timings['banner'] * 1000:.1f} ms")
+    parts.append(f"ready after {(time.perf_counter() - STARTED) * 1000:.1f} ms")
+    print("startup: " + ", ".join(parts), file=sys.stderr)
+
+
+def make_completer(book, readline):
+    """
+    Returns a readline completer of command names for the first word of the
+    line and of contact names (see AddressBook.complete_names) for the first
+    argument of NAME_COMMANDS.
+    """
+    matches = []
+
+    def complete(text, state):
+        # readline asks for the matches one at a time, state counting from 0
+        if state == 0:
+            words = readline.get_line_buffer()[:readline.get_begidx()].split()
+            if not words:
+                matches[:] = sorted(command for command in HANDLERS if command.startswith(text))
+            elif len(words) == 1 and words[0] in NAME_COMMANDS:
+                matches[:] = book.complete_names(text)
+            else:
+                matches.clear()
+        return matches[state] if state < len(matches) else None
+
+    return complete
+
+
+def enable_completion(book):
+    try:
+        import readline
+    except ImportError:
+        # readline is not available on every platform, input() still works without it
+        return
+    readline.set_completer_delims(' \t\n')
+    readline.set_completer(make_completer(book, readline))
+    if 'libedit' in (readline.__doc__ or ''):
+        readline.parse_and_bind('bind ^I rl_complete')
+    else:
+        readline.parse_and_bind('tab: complete')
+
+
+def run_batch(lines, book, save_every=0, output_format='table'):
+    """
+    Runs commands read from lines, one per line, without prompting.
+
+    Empty lines and lines starting with "#" are skipped, and close or exit ends
+    the batch. Changes are saved once at the end, or after every save_every
+    commands. Replies go to stdout in output_format (see print_result) and
+    failed commands to stderr with their line number (see failure_line).
+
+    Returns the exit code: 0 if every command succeeded and the changes were
+    saved, 1 otherwise.
+    """
+    from assistant_x.storage import BookLocked, get_persister
+
+    persister = get_persister()
+    persister.deferred = True
+    failed = 0
+    executed = 0
+    try:
+        for line_number, line in enumerate(lines, 1):
+            command = line.split()
+            if not command or command[0].startswith('#'):
+                continue
+            if HANDLERS.get(command[0]) == 'close_handler':
+                break
+
+            result = run_command(command, book)
+            if isinstance(result, CommandError):
+                failed += 1
+                print(failure_line(line_number, result, output_format), file=sys.stderr)
+            elif result:
+                print_result(result, output_format)
+
+            executed += 1
+            if save_every and executed % save_every == 0:
+                try:
+                    persister.flush()
+                except BookLocked as error:
+                    # The changes stay pending and go out with the next save
+                    print(error, file=sys.stderr)
+    finally:
+        saved = persister.close()
+    return 1 if failed or not saved else 0
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog='assistant_x', description="Address Book Assistant X")
+    parser.add_argument(
+        'mode', nargs='?', choices=('serve',),
+        help="serve: keep the book loaded and answer JSON-RPC requests on --socket or --port",
+    )
+    parser.add_argument(
+        '--batch', metavar='FILE',
+        help="run the commands in FILE ('-' for standard input) instead of prompting for them; "
+             "commands are also read from standard input when it is not a terminal",
+    )
+    parser.add_argument(
+        '--save-every', metavar='N', type=int, default=0,
+        help="in batch mode, save after every N commands instead of once at the end",
+    )
+    parser.add_argument(
+        '--output', choices=OUTPUT_FORMATS, default='table',
+        help="print replies as tables and text (the default) or as JSON, JSON Lines or TSV records",
+    )
+    parser.add_argument(
+        '--quiet', action='store_true',
+        help="start at the prompt, without the banner and the list of commands",
+    )
+    parser.add_argument(
+        '--startup-profile', action='store_true',
+        help="report to stderr how long imports, loading the book and reaching the prompt took",
+    )
+    parser.add_argument('--socket', metavar='PATH', help="serve on a Unix socket at PATH")
+    parser.add_argument('--port', metavar='PORT', type=int, help="serve on a TCP port of 127.0.0.1")
+    arguments = parser.parse_args(argv)
+    if arguments.mode == 'serve' and (arguments.socket is None) == (arguments.port is None):
+        parser.error("serve needs either --socket PATH or --port PORT")
+    return arguments
+
+
+def main(argv=None):
+    arguments = parse_arguments(argv)
+    start_profiling()
+    timings = {}
+
+    if arguments.mode == 'serve':
+        from assistant_x.server import serve
+
+        book = load_book(timings)
+        if arguments.startup_profile:
+            report_startup(timings, book)
+        return serve(book, arguments.socket, arguments.port)
+
+    if arguments.batch not in (None, '-'):
+        try:
+            commands = open(arguments.batch, encoding='utf-8')
+        except OSError as error:
+            print(f"Cannot read {arguments.batch}: {error}", file=sys.stderr)
+            return 2
+        with commands:
+            book = load_book(timings)
+            if arguments.startup_profile:
+                report_startup(timings, book)
+            return run_batch(commands, book, arguments.save_every, arguments.output)
+    if arguments.batch == '-' or not sys.stdin.isatty():
+        book = load_book(timings)
+        if arguments.startup_profile:
+            report_startup(timings, book)
+        return run_batch(sys.stdin, book, arguments.save_every, arguments.output)
+
+    # The book is loaded while the banner is printed
+    loaded = {}
+
+    def load():
+        try:
+            loaded['book'] = load_book(timings)
+        except BaseException as error:
+            loaded['error'] = error
+
+    loader = threading.Thread(target=load, name='load-book', daemon=True)
+    loader.start()
+
+    if not arguments.quiet:
+        started = time.perf_counter()
+        print_app_intro()
+        print("Welcome to the Address Book Assistant X!")
+        print_help()
+        timings['banner'] = time.perf_counter() - started
+
+    loader.join()
+    if 'error' in loaded:
+        raise loaded['error']
+    book = loaded['book']
+    if arguments.startup_profile:
+        report_startup(timings, book)
+    enable_completion(book)
 
     try:
         while True:
             command = input("Enter a command >>>  ").split()
 
             if command:
-                handler = handlers.get(command[0])
-                if handler:
-                    print(handler(command, book=book))
-                else:
-                    print("Unknown command")
+                print_result(run_command(command, book), arguments.output)
             else:
                 print("Please enter a command.")
     except KeyboardInterrupt:
-        close_handler()
+        get_handler('close')()
+    except EOFError:
+        # Ctrl-D
+        print()
+        get_handler('close')()
+    finally:
+        from assistant_x.storage import get_persister
+
+        # Changes still waiting for a background flush are saved however the session ends
+        get_persister().close()
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -1,14 +1,31 @@
+from assistant_x.indexes import (
+    AddressIndex, BirthdayIndex, EmailIndex, FuzzyIndex, NameIndex, NoteIndex, PhoneIndex, PrefixIndex,
+    paused_gc, rank_names, similar_names, split_field_query,
+)
+from assistant_x.validation import check_birthday, check_email, check_phone
 from collections import UserDict
+from collections.abc import Mapping
+import calendar
 import datetime
-import os
-import pickle
-import re
+import itertools
+import sys
+import time
+import weakref
+
+
+# Most phone numbers and notes a contact can have: snapshots and the journal store
+# their counts in one and two bytes (see snapshot.RECORD)
+MAX_PHONES = 255
+MAX_NOTES = 65535
 
 
 class Field:
     """
     Base class for representing various types of contact data.
 
+    Fields use __slots__ instead of a __dict__, since a large book holds
+    millions of them.
+
     Attributes:
         value: Variable that holds the value of the given type.
 
@@ -16,19 +33,28 @@ class Field:
         __str__(): Converts the field value to a string.
     """
 
+    __slots__ = ()
+
     def __init__(self, value):
         self.value = value
 
     def __str__(self):
         return str(self.value)
 
+    def __getstate__(self):
+        return {'value': self.value}
+
+    def __setstate__(self, state):
+        # Fields pickled before they had slots come with their __dict__, which is the same mapping
+        self.value = state['value']
+
 
 class Name(Field):
     """
     Subclass of Field for storing the name of a contact.
     """
 
-    pass
+    __slots__ = ('value',)
 
 
 class Note(Field):
@@ -36,7 +62,7 @@ class Note(Field):
     Subclass of Field for storing a note or comment about a contact.
     """
 
-    pass
+    __slots__ = ('value',)
 
 
 class Phone(Field):
@@ -44,28 +70,54 @@ class Phone(Field):
     Subclass of Field for storing the phone number of a contact.
 
     Attributes:
-        value: Variable that holds the phone number.
+        value: The phone number as a 10-digit string.
+        number (int): The phone number as stored.
 
     Methods:
         __init__(): Phone number initialization, with validation.
         validate(): Check if the phone number is in 10-digit format.
+        from_number(number: int): Create a phone number from its stored form.
     """
 
+    __slots__ = ('number',)
+
     def __init__(self, value):
-        super().__init__(value)
-        if not self.validate():
+        self.value = value
+
+    @property
+    def value(self):
+        return f"{self.number:010d}"
+
+    @value.setter
+    def value(self, value):
+        number = check_phone(value)
+        if number is None:
             raise ValueError("Invalid phone number")
+        self.number = number
 
-    def validate(self):
-        return len(self.value) == 10 and self.value.isdigit()
+    @classmethod
+    def from_number(cls, number):
+        # Used when loading a stored number that was already validated
+        phone = cls.__new__(cls)
+        phone.number = number
+        return phone
+
+    def validate(self, value=None):
+        if value is None:
+            value = self.value
+        return check_phone(value) is not None
 
 
 class Address(Field):
     """
     Subclass of Field for storing the address of a contact.
+    Addresses are interned, as people of a household or office share them.
     """
 
-    pass
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = sys.intern(value)
 
 
 class Email(Field):
@@ -78,16 +130,25 @@ class Email(Field):
     Methods:
         __init__(): Email initialization, with validation.
         validate(): Check email for compliance with the standard format.
+        from_valid(value: str): Create an email from an address that was already validated.
     """
 
+    __slots__ = ('value',)
+
     def __init__(self, value):
         super().__init__(value)
         if not self.validate():
             self.value = None
 
+    @classmethod
+    def from_valid(cls, value):
+        # Used when loading a stored email, or one the importer validated in bulk
+        email = cls.__new__(cls)
+        email.value = value
+        return email
+
     def validate(self):
-        pattern = r'^[A-Za-z0-9._%-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,4}$'
-        return re.match(pattern, self.value) is not None
+        return check_email(self.value) is not None
 
 
 class Birthday(Field):
@@ -95,29 +156,62 @@ class Birthday(Field):
     Subclass of Field for storing the date of birth of a contact.
 
     Attributes:
-        value: Variable that holds the date of birth.
+        value: The date of birth as a datetime.
+        ordinal (int): The date of birth as stored, a day ordinal.
 
     Methods:
         __init__(): Date of birth initialization, with validation.
         validate(): Check if the date of birth is in DD.MM.YYYY format.
+        from_ordinal(ordinal: int): Create a date of birth from a day ordinal.
+        next_date(today: date): Date of the next birthday, today included.
     """
 
+    __slots__ = ('ordinal',)
+
     def __init__(self, date_string):
-        self.value = self.validate(date_string)
-        if not self.value:
+        ordinal = check_birthday(date_string)
+        if ordinal is None:
             raise ValueError("Invalid birthday format. Use DD.MM.YYYY")
+        self.ordinal = ordinal
+
+    @property
+    def value(self):
+        return datetime.datetime.fromordinal(self.ordinal)
+
+    @value.setter
+    def value(self, value):
+        self.ordinal = value.toordinal()
+
+    @classmethod
+    def from_ordinal(cls, ordinal):
+        # Used when loading a stored date that was already validated
+        birthday = cls.__new__(cls)
+        birthday.ordinal = ordinal
+        return birthday
 
     def validate(self, date_string):
-        try:
-            return datetime.datetime.strptime(date_string, "%d.%m.%Y")
-        except ValueError:
-            return None
+        ordinal = check_birthday(date_string)
+        return None if ordinal is None else datetime.datetime.fromordinal(ordinal)
+
+    def next_date(self, today):
+        date = datetime.date.fromordinal(self.ordinal)
+        month, day = date.month, date.day
+        for year in (today.year, today.year + 1):
+            # February 29 birthdays are celebrated on February 28 in other years
+            if (month, day) == (2, 29) and not calendar.isleap(year):
+                birthday_date = datetime.date(year, 2, 28)
+            else:
+                birthday_date = datetime.date(year, month, day)
+            if birthday_date >= today:
+                return birthday_date
 
 
 class Record:
     """
     This class describes an entry in the address book.
 
+    Records use __slots__ instead of a __dict__, like their fields.
+
     Attributes:
         name (Name): Contact name.
         phones (list): List of phone numbers for the contact.
@@ -125,6 +219,7 @@ class Record:
         address (Address): Contact's address.
         email (Email): Contact's email address.
         notes (list): List of notes about the contact.
+        book (AddressBook): Address book the record belongs to, set by AddressBook.add_record.
 
     Methods:
         add_phone(phone_number: str): Add a phone number to the phone list.
@@ -132,13 +227,16 @@ class Record:
         edit_phone(old_number: str, new_number: str): Change a phone number in the list.
         find_phone(phone_number: str): Find a phone number in the list.
         add_birthday(birthday: datetime.date): Add date of birth.
-        days_to_birthday(): Calculate days until birthday.
+        days_to_birthday(today: date = None): Calculate days until birthday.
         show_notes(): Show all notes.
         add_note(note: str): Add a note.
         edit_note(note_index: int, new_note: str): Edit a note.
         remove_note(note_index: int): Delete a note.
+        copy(): Returns a copy that shares the fields, which are replaced rather than changed in place.
     """
 
+    __slots__ = ('name', 'phones', 'birthday', 'address', 'email', 'notes', 'book')
+
     def __init__(self, name):
         self.name = Name(name)
         self.phones = []
@@ -146,30 +244,83 @@ class Record:
         self.address = None
         self.email = None
         self.notes = []
+        self.book = None
+
+    def __getstate__(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__ if slot != 'book'}
+
+    def __setstate__(self, state):
+        # Records pickled before they had slots come with their __dict__, which may lack newer fields
+        self.phones = []
+        self.birthday = None
+        self.address = None
+        self.email = None
+        self.notes = []
+        self.book = None
+        for slot, value in state.items():
+            if slot in self.__slots__:
+                setattr(self, slot, value)
+
+    def copy(self):
+        record = Record.__new__(Record)
+        record.name = self.name
+        record.phones = list(self.phones)
+        record.birthday = self.birthday
+        record.address = self.address
+        record.email = self.email
+        record.notes = list(self.notes)
+        record.book = None
+        return record
+
+    def _changing(self):
+        # Snapshots of the owning book that still share the record keep a copy of it first
+        if self.book is not None:
+            self.book.record_changing(self)
+
+    def _changed(self, field):
+        # Let the owning book know the record has to be persisted and re-indexed
+        if self.book is not None:
+            self.book.record_changed(self, field)
 
     def add_phone(self, phone_number):
+        if len(self.phones) >= MAX_PHONES:
+            raise ValueError(f"A contact can have at most {MAX_PHONES} phone numbers")
+        self._changing()
         self.phones.append(Phone(phone_number))
+        self._changed('phones')
 
     def add_address(self, address):
+        self._changing()
         self.address = Address(address)
+        self._changed('address')
 
     def add_email(self, email):
         email_obj = Email(email)
         if email_obj.value is None:  # Check if email is invalid
             print("Invalid email address. Please try again.")
         else:
+            self._changing()
             self.email = email_obj
+            self._changed('email')
 
     def add_note(self, note):
+        if len(self.notes) >= MAX_NOTES:
+            raise ValueError(f"A contact can have at most {MAX_NOTES} notes")
+        self._changing()
         self.notes.append(Note(note))
+        self._changed('notes')
 
     def remove_phone(self, phone_number):
+        self._changing()
         self.phones = [phone for phone in self.phones if phone.value != phone_number]
+        self._changed('phones')
 
     def edit_phone(self, old_number, new_number):
-        for phone in self.phones:
+        for position, phone in enumerate(self.phones):
             if phone.value == old_number:
-                phone.value = new_number
+                self._changing()
+                self.phones[position] = Phone(new_number)
+                self._changed('phones')
                 break
 
     def find_phone(self, phone_number):
@@ -180,37 +331,33 @@ class Record:
     def edit_note(self, note_index, new_note):
         if note_index < 0 or note_index >= len(self.notes):
             return "Invalid note index"
+        self._changing()
         self.notes[note_index] = Note(new_note)
+        self._changed('notes')
 
     def remove_note(self, note_index):
         if note_index < 0 or note_index >= len(self.notes):
             return "Invalid note index"
+        self._changing()
         del self.notes[note_index]
+        self._changed('notes')
 
     def show_notes(self):
         return '; '.join(note.value for note in self.notes)
 
     def add_birthday(self, birthday):
+        self._changing()
         self.birthday = birthday
+        self._changed('birthday')
         return True
 
-    def days_to_birthday(self):
+    def days_to_birthday(self, today=None):
         if not self.birthday:
             return None
 
-        today = datetime.date.today()
-        birthday_date = datetime.date(
-            today.year, self.birthday.value.month, self.birthday.value.day
-        )
-
-        if (
-                birthday_date < today
-        ):  # If birthday has passed this year, calculate for next year
-            birthday_date = datetime.date(
-                today.year + 1, self.birthday.value.month, self.birthday.value.day
-            )
-
-        return (birthday_date - today).days
+        if today is None:
+            today = datetime.date.today()
+        return (self.birthday.next_date(today) - today).days
 
     def __str__(self):
         result = f"Contact name: {self.name.value}, phones: {'; '.join(p.value for p in self.phones)}"
@@ -229,14 +376,93 @@ class Record:
         return result
 
 
+class BookSnapshot(Mapping):
+    """
+    Read-only view of an address book as it was when AddressBook.snapshot() was taken.
+
+    Nothing is copied up front that the book does not hold in memory: a lazily
+    loaded book copies the records it has read (see LazyRecords.copy) and shares
+    the snapshot file, a SQLite one reads through a transaction of its own (see
+    SQLiteRecords.copy). Records are shared with the book until the book is about
+    to change one of them in place, when the view is handed a copy of it first
+    (see freeze). So reading the view, from any thread and for as long as it
+    takes, sees neither changes made meanwhile nor records half changed.
+
+    The view follows the book for as long as it is referenced. Records read from
+    it must not be changed.
+
+    Attributes:
+        data: The records of the book, detached from it.
+        generation (int): Generation of the book when the snapshot was taken.
+
+    Methods:
+        freeze(record: Record): Keeps record as it is, before the book changes it.
+        find(name: str): Finds a record by name.
+        values(): Iterates over all records.
+        scan(names=None): Iterates over the records (all, or those named) without keeping them in memory.
+    """
+
+    # Mapping compares by content, snapshots are kept in a WeakSet by identity
+    __hash__ = object.__hash__
+
+    def __init__(self, data, generation):
+        self.data = data
+        self.generation = generation
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, name):
+        return name in self.data
+
+    def freeze(self, record):
+        name = record.name.value
+        freeze = getattr(self.data, 'freeze', None)
+        if freeze is not None:
+            freeze(name, record)
+        elif self.data.get(name) is record:
+            self.data[name] = record.copy()
+
+    def find(self, name):
+        return self.data.get(name)
+
+    def values(self):
+        # A generator, so the view stays referenced while it is being iterated
+        yield from self.data.values()
+
+    def scan(self, names=None):
+        scan = getattr(self.data, 'scan', None)
+        if scan is not None:
+            yield from scan(names)
+        elif names is None:
+            yield from self.data.values()
+        else:
+            yield from (self.data[name] for name in names)
+
+
 class AddressBook(UserDict):
     """
     This class represents the entire address book.
 
     Attributes:
         data (dict): Dictionary where the key is the contact's name, and the value is an instance of the Record class.
+        changes (set): Names of the records added, changed or deleted since the book was last saved.
+        indexes (dict): Search indexes built so far, by kind (see INDEXES).
+        generation (int): Changes with every change to the book; unique across all books.
+        snapshots (WeakSet): Snapshots taken of the book that are still referenced.
 
     Methods:
+        snapshot(): Returns a read-only view of the book as it is now, see BookSnapshot.
+        record_changing(record: Record): Lets the snapshots keep a record that is about to change.
+        record_changed(record: Record, field: str): Marks a record as changed and re-indexes it.
+        reload_records(names=None): Re-indexes records that storage replaced with versions saved elsewhere.
+        index(kind: str): Returns the index of the given kind, building it on first use.
         add_record(record: Record): Adds a record to the address book.
         find(name: str): Finds a record by name.
         delete(name: str): Deletes a record by name.
@@ -248,7 +474,18 @@ class AddressBook(UserDict):
         show_address(name: str): Displays a contact's address.
         show_notes(name: str): Displays a contact's notes.
         show_all(): Displays all records in the address book.
-        find_contacts(search_query): Finds contacts based on their name or phone number.
+        page(start: int, count: int): Returns count records from position start, in book order.
+        complete_names(prefix: str, limit: int): Returns the names starting with prefix for tab
+            completion, sorted, or none when more than limit names match.
+        find_names(search_query, ranked=False): Finds the names of the contacts matching a query, see find_contacts.
+        find_contacts(search_query, ranked=False): Finds contacts based on their name, phone number, or "email:", "domain:", "address:" or "city:" queries.
+        iter_contacts(search_query=None): Iterates over all contacts, or those matching a query, without keeping them in memory.
+        find_notes(terms: str): Finds notes containing any of the terms, best matches first.
+        upcoming_birthdays(days: int, today: date = None): Finds the contacts with a birthday
+            in the next days, as (record, days left) pairs ordered by days left.
+        find_similar(name: str): Finds contacts whose name is within a few typos of name.
+        suggest(name: str, limit: int): Returns the names closest to a name that was not found,
+            of those found within SUGGEST_SECONDS.
     """
 
 
@@ -263,15 +500,115 @@ class AddressBook(UserDict):
     #     except FileNotFoundError:
     #         self.data = {}
 
+    INDEXES = {
+        'addresses': AddressIndex,
+        'birthdays': BirthdayIndex,
+        'emails': EmailIndex,
+        'fuzzy': FuzzyIndex,
+        'names': NameIndex,
+        'notes': NoteIndex,
+        'phones': PhoneIndex,
+        'prefixes': PrefixIndex,
+    }
+
+    # Time a lookup of suggestions for a name that was not found may take
+    SUGGEST_SECONDS = 0.1
+
+    _generations = itertools.count()
+
+    def __init__(self, *args, **kwargs):
+        self.changes = set()
+        self.indexes = {}
+        self.generation = next(self._generations)
+        self.snapshots = weakref.WeakSet()
+        super().__init__(*args, **kwargs)
+
+    def __getstate__(self):
+        return {'data': self.data}
+
+    def __setstate__(self, state):
+        self.changes = set()
+        self.indexes = {}
+        self.generation = next(self._generations)
+        self.snapshots = weakref.WeakSet()
+        self.data = state['data']
+        for record in self.data.values():
+            record.book = self
+
+    def __setitem__(self, name, record):
+        record.book = self
+        self.data[name] = record
+        self.changes.add(name)
+        self.generation = next(self._generations)
+        for index in self.indexes.values():
+            index.update(record)
+
+    def __delitem__(self, name):
+        record = self.data.pop(name)
+        record.book = None
+        self.changes.add(name)
+        self.generation = next(self._generations)
+        for index in self.indexes.values():
+            index.discard(name)
+
+    def snapshot(self):
+        # Taken while the book is not being changed, e.g. under the storage lock or
+        # the server's read lock; afterwards the book may change freely
+        snapshot = BookSnapshot(self.data.copy(), self.generation)
+        self.snapshots.add(snapshot)
+        return snapshot
+
+    def record_changing(self, record):
+        for snapshot in list(self.snapshots):
+            snapshot.freeze(record)
+
+    def record_changed(self, record, field):
+        self.changes.add(record.name.value)
+        self.generation = next(self._generations)
+        for index in self.indexes.values():
+            if field in index.fields:
+                index.update(record)
+
+    def reload_records(self, names=None):
+        # Storage replaced these records (all of them when names is None) behind the
+        # book's back, with the versions saved by another process
+        if names is not None and not names:
+            return
+        self.generation = next(self._generations)
+        if names is None:
+            self.indexes = {}
+            return
+        for name in names:
+            record = self.data.get(name)
+            if record is not None:
+                record.book = self
+            for index in self.indexes.values():
+                if record is None:
+                    index.discard(name)
+                else:
+                    index.update(record)
+
+    def index(self, kind):
+        index = self.indexes.get(kind)
+        if index is None:
+            # Storage backends that keep indexes on disk (e.g. files) load them from there
+            load_index = getattr(self.data, 'load_index', None)
+            with paused_gc():
+                index = load_index(kind, self.INDEXES[kind]) if load_index else None
+                if index is None:
+                    index = self.INDEXES[kind]()
+                    index.build(self)
+            self.indexes[kind] = index
+        return index
 
     def add_record(self, record):
-        self.data[record.name.value] = record
+        self[record.name.value] = record
 
     def find(self, name):
         return self.data.get(name)
 
     def delete(self, name):
-        del self.data[name]
+        del self[name]
 
     def change_phone(self, name, new_phone):
         record = self.data.get(name)
@@ -286,8 +623,10 @@ class AddressBook(UserDict):
             record.add_email(new_email)
 
     # New method to change address
-    def change_address(self, new_address):
-        self.address = new_address
+    def change_address(self, name, new_address):
+        record = self.data.get(name)
+        if record:
+            record.add_address(new_address)
 
     def show_phone(self, name):
         record = self.data.get(name)
@@ -321,19 +660,84 @@ class AddressBook(UserDict):
     def show_all(self):
         if not self.data:
             return "Contacts were not added"
-        return self.data.values()
-
-    def find_contacts(self, search_query):
-        search_results = []
-        is_phone = search_query.isdigit()
-
-        for record in self.data.values():
-            if is_phone:
-                # Search by phone
-                if any(search_query in phone.value for phone in record.phones):
-                    search_results.append(record)
-            else:
-                # Search by name
-                if search_query.lower() in record.name.value.lower():
-                    search_results.append(record)
-        return search_results
+        return self.snapshot().values()
+
+    def page(self, start, count):
+        # Only the names are walked up to start, records are read for the page alone
+        names = list(itertools.islice(iter(self.data), start, start + count))
+        return self._records(names)
+
+    def find_names(self, search_query, ranked=False):
+        # Storage backends that can search on their own (e.g. SQLite) do so
+        backend_search = getattr(self.data, 'find_names', None)
+        if backend_search:
+            return backend_search(search_query, ranked)
+
+        field, value = split_field_query(search_query)
+        if field == 'email' and not value.startswith('@'):
+            names = self.index('emails').search(value)
+        elif field in ('email', 'domain'):
+            names = self.index('emails').search_domain(value)
+        elif field in ('address', 'city'):
+            names = self.index('addresses').search(value)
+        elif search_query.isdigit():
+            # Search by phone
+            names = self.index('phones').search(search_query)
+        elif search_query.endswith('*'):
+            # Search by the start of the name
+            names = self.index('prefixes').starts_with(search_query[:-1])
+        else:
+            # Search by name
+            names = self.index('names').search(search_query.casefold())
+
+        if ranked and field is None:
+            names = rank_names(names, search_query.rstrip('*'))
+        return names
+
+    def complete_names(self, prefix, limit=100):
+        return self.index('prefixes').complete(prefix, limit)
+
+    def find_contacts(self, search_query, ranked=False):
+        return self._records(self.find_names(search_query, ranked))
+
+    def _records(self, names):
+        # Records deleted by another thread since their names were found are left out
+        records = map(self.data.get, names)
+        return [record for record in records if record is not None]
+
+    def iter_contacts(self, search_query=None):
+        names = None if search_query is None else self.find_names(search_query)
+        # Read from a snapshot, so the book may change while the contacts are being read;
+        # lazily loaded books read records from storage without caching them
+        return self.snapshot().scan(names)
+
+    def find_notes(self, terms):
+        return [
+            (name, note_index, self.data[name].notes[note_index].value, score)
+            for score, name, note_index in self.index('notes').search(terms)
+        ]
+
+    def upcoming_birthdays(self, days, today=None):
+        if today is None:
+            today = datetime.date.today()
+        upcoming = []
+        for name in self.index('birthdays').upcoming(today, days):
+            record = self.data[name]
+            days_left = record.days_to_birthday(today)
+            if days_left <= days:
+                upcoming.append((record, days_left))
+        return sorted(upcoming, key=lambda item: item[1])
+
+    def find_similar(self, name):
+        return [self.data[similar] for _, similar in self.index('fuzzy').search(name)]
+
+    def suggest(self, name, limit=3):
+        # A name not found is answered at once: the suggestions are those found within
+        # SUGGEST_SECONDS, and without building the fuzzy index just for them
+        deadline = time.perf_counter() + self.SUGGEST_SECONDS
+        index = self.indexes.get('fuzzy')
+        if index is None:
+            hits = similar_names(name, self.data, deadline=deadline)
+        else:
+            hits = index.search(name, deadline=deadline)
+        return [similar for _, similar in hits[:limit]]
@@ -0,0 +1,277 @@
+from assistant_x.exporter import encode_json
+from assistant_x.helpers import CommandError, reply_object
+from assistant_x.main import HANDLERS, get_handler
+from assistant_x.storage import get_persister, get_storage, report_conflicts
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import asyncio
+import json
+import os
+import signal
+import stat
+
+
+# Commands that only make sense at the prompt
+LOCAL_COMMANDS = {'help', 'close', 'exit'}
+
+# Commands that read or write files as the user running the server; any local user
+# can connect to a TCP port, so they are only served on the Unix socket
+FILE_COMMANDS = {'import', 'export'}
+
+# Permissions the Unix socket is created with, so only the user running the server can connect
+SOCKET_UMASK = 0o177
+
+# Threads the handlers run in, so reads are served side by side and the event loop never waits
+WORKERS = 8
+
+# Seconds between checks for changes saved by other assistant_x processes
+REFRESH_INTERVAL = 1.0
+
+# Requests are single lines of JSON, longer ones are refused
+MAX_REQUEST_SIZE = 1024 * 1024
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+# The command ran and replied with a CommandError
+COMMAND_ERROR = -32000
+
+
+class ReadWriteLock:
+    """
+    Lets any number of readers, or a single writer, in at a time.
+
+    A waiting writer keeps new readers out, so a stream of reads cannot hold a write back forever.
+
+    Methods:
+        reading(): Async context manager held while reading.
+        writing(): Async context manager held while writing.
+    """
+
+    def __init__(self):
+        self.readers = 0
+        self.writing_now = False
+        self.waiting_writers = 0
+        self.condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def reading(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.writing_now and not self.waiting_writers)
+            self.readers += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.readers -= 1
+                self.condition.notify_all()
+
+    @asynccontextmanager
+    async def writing(self):
+        async with self.condition:
+            self.waiting_writers += 1
+            try:
+                await self.condition.wait_for(lambda: not self.writing_now and not self.readers)
+            finally:
+                self.waiting_writers -= 1
+            self.writing_now = True
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.writing_now = False
+                self.condition.notify_all()
+
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class BookServer:
+    """
+    Serves the commands of the address book as JSON-RPC 2.0 methods.
+
+    Every line a client sends is a request (or a batch of requests): the method
+    is a command name and params the list of its arguments, one argument per
+    param: a param is passed on as given, spaces included, where the prompt
+    would split it in several (e.g. a name of two words). The result is the
+    reply as --output json prints it (see helpers.reply_object); a CommandError
+    reply is returned as an error with code COMMAND_ERROR.
+
+    The book stays loaded. Handlers run in a pool of threads. Those that change
+    the book run one at a time and never during a read (see ReadWriteLock).
+    Read-only ones hold the lock of the storage while they read (see
+    handlers.reads_book), which also keeps a background flush from applying the
+    saves of other processes to the book meanwhile, so they take turns as well.
+    Changes are saved by the handler's thread, so the event loop keeps serving
+    while a save waits for the disk.
+
+    Attributes:
+        book (AddressBook): The book being served.
+        lock (ReadWriteLock): Keeps reads and writes of the book apart.
+        executor (ThreadPoolExecutor): Threads the handlers run in.
+        file_commands (bool): Whether FILE_COMMANDS are served, only on the Unix socket.
+
+    Methods:
+        handle(request): Returns the response to a decoded request, or None for a notification.
+        serve(path=None, port=None): Accepts clients on a Unix socket or on a localhost TCP port until stopped.
+    """
+
+    def __init__(self, book):
+        self.book = book
+        self.lock = ReadWriteLock()
+        self.executor = ThreadPoolExecutor(WORKERS, thread_name_prefix='ab-server')
+        self.file_commands = False
+
+    async def run(self, func):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func)
+
+    async def call(self, method, params):
+        if not isinstance(method, str) or method in LOCAL_COMMANDS or method not in HANDLERS:
+            raise RPCError(METHOD_NOT_FOUND, f"Unknown method {method}")
+        if method in FILE_COMMANDS and not self.file_commands:
+            raise RPCError(METHOD_NOT_FOUND, f"{method} is only served on a Unix socket")
+        if params is None:
+            params = []
+        if not isinstance(params, list) or not all(isinstance(param, str) for param in params):
+            raise RPCError(INVALID_PARAMS, "params must be a list of strings")
+
+        handler = get_handler(method)
+        args = [method] + params
+        if getattr(handler, 'changes_book', False):
+            async with self.lock.writing():
+                result = await self.run(lambda: self._write(handler, args))
+        else:
+            async with self.lock.reading():
+                result = await self.run(lambda: handler(args, book=self.book))
+
+        if isinstance(result, CommandError):
+            raise RPCError(COMMAND_ERROR, str(result))
+        return reply_object(result)
+
+    def _write(self, handler, args):
+        # Changes saved by other processes go in first, see refresh()
+        report_conflicts(get_storage().refresh(self.book))
+        return handler(args, book=self.book)
+
+    async def handle(self, request):
+        valid = isinstance(request, dict) and request.get('jsonrpc') == '2.0' and 'method' in request
+        request_id = request.get('id') if valid else None
+        try:
+            if not valid:
+                raise RPCError(INVALID_REQUEST, "Invalid request")
+            result = await self.call(request['method'], request.get('params'))
+        except RPCError as error:
+            response = {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': error.code, 'message': error.message}}
+        except Exception as error:
+            message = f"{type(error).__name__}: {error}"
+            response = {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': INTERNAL_ERROR, 'message': message}}
+        else:
+            response = {'jsonrpc': '2.0', 'id': request_id, 'result': result}
+
+        if valid and 'id' not in request:
+            # A notification, which gets no response
+            return None
+        return response
+
+    async def respond(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {'jsonrpc': '2.0', 'id': None, 'error': {'code': PARSE_ERROR, 'message': "Parse error"}}
+        if isinstance(request, list):
+            if not request:
+                return {'jsonrpc': '2.0', 'id': None, 'error': {'code': INVALID_REQUEST, 'message': "Empty batch"}}
+            responses = await asyncio.gather(*map(self.handle, request))
+            return [response for response in responses if response is not None] or None
+        return await self.handle(request)
+
+    async def client(self, reader, writer):
+        # Requests of one client are answered concurrently, in the order they finish
+        tasks = set()
+        write_lock = asyncio.Lock()
+
+        async def answer(line):
+            response = await self.respond(line)
+            if response is None:
+                return
+            data = encode_json(response).encode() + b'\n'
+            async with write_lock:
+                writer.write(data)
+                await writer.drain()
+
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (asyncio.LimitOverrunError, ValueError):
+                    break
+                if not line:
+                    break
+                if line.strip():
+                    task = asyncio.create_task(answer(line))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def refresh_periodically(self):
+        while True:
+            await asyncio.sleep(REFRESH_INTERVAL)
+            async with self.lock.writing():
+                conflicts = await self.run(lambda: get_storage().refresh(self.book))
+            report_conflicts(conflicts)
+
+    async def serve(self, path=None, port=None):
+        if path is not None:
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                # Left behind by a server that did not shut down cleanly
+                os.remove(path)
+            # Set before the socket exists, a chmod afterwards would leave a window open
+            umask = os.umask(SOCKET_UMASK)
+            try:
+                server = await asyncio.start_unix_server(self.client, path, limit=MAX_REQUEST_SIZE)
+            finally:
+                os.umask(umask)
+            self.file_commands = True
+            print(f"Serving the address book on {path}", flush=True)
+        else:
+            server = await asyncio.start_server(self.client, '127.0.0.1', port, limit=MAX_REQUEST_SIZE)
+            print(f"Serving the address book on 127.0.0.1:{port}", flush=True)
+
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signal_number, stopped.set)
+            except (NotImplementedError, AttributeError):
+                pass
+        refresher = asyncio.create_task(self.refresh_periodically())
+
+        async with server:
+            await stopped.wait()
+        refresher.cancel()
+        # Waits for running handlers before the final save
+        self.executor.shutdown(wait=True)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+
+def serve(book, path=None, port=None):
+    """Serves book on a Unix socket at path or on a localhost TCP port until SIGINT or SIGTERM; returns the exit code."""
+    try:
+        asyncio.run(BookServer(book).serve(path, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        get_persister().close()
+    return 0
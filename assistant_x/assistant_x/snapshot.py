@@ -0,0 +1,444 @@
+from assistant_x.models import Address, Birthday, Email, Note, Phone, Record
+import lzma
+import mmap
+import os
+import pickle
+import struct
+import zlib
+
+
+MAGIC = b"AX51BOOK"
+VERSION = 3
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+
+COMPRESSIONS = {
+    "none": COMPRESSION_NONE,
+    "zlib": COMPRESSION_ZLIB,
+    "lzma": COMPRESSION_LZMA,
+}
+
+# Records are compressed in blocks of about this many bytes
+BLOCK_SIZE = 64 * 1024
+
+# magic, version, compression, record count, offset of the entries, offset of the sorted positions,
+# sequence number of the last save included
+HEADER = struct.Struct("<8sHHQQQQ")
+# Version 1 and 2 headers: the same without the sequence number
+HEADER_V2 = struct.Struct("<8sHHQQQ")
+VERSION_PREFIX = struct.Struct("<8sH")
+# block offset, block length, record offset inside the block, record length, name length
+ENTRY = struct.Struct("<QIIIH")
+# Version 1 entries: record offset, record length, name length
+ENTRY_V1 = struct.Struct("<QIH")
+POSITION = struct.Struct("<Q")
+
+# Record encoding: flags, birthday as a day ordinal (0 when missing), number of phones, number of notes
+# (which models.MAX_PHONES and models.MAX_NOTES keep within range)
+RECORD = struct.Struct("<BIBH")
+LENGTH = struct.Struct("<I")
+SHORT_LENGTH = struct.Struct("<H")
+
+HAS_ADDRESS = 1
+HAS_EMAIL = 2
+
+
+def is_snapshot(path):
+    with open(path, "rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def _pack_string(value, length=LENGTH):
+    data = value.encode()
+    return length.pack(len(data)) + data
+
+
+def _unpack_string(payload, offset, length=LENGTH):
+    size, = length.unpack_from(payload, offset)
+    offset += length.size
+    return bytes(payload[offset:offset + size]).decode(), offset + size
+
+
+def encode_record(record):
+    """
+    Encodes a record into the compact binary form used by snapshots and the journal.
+
+    Layout: flags (u8), birthday day ordinal (u32, 0 when missing), phone count (u8),
+    note count (u16), name (u16 length + UTF-8), phones (u64 each, the 10 digits
+    as a number), then address and email (u32 length + UTF-8) when their flag is
+    set, then the notes (u32 length + UTF-8 each).
+    """
+    flags = 0
+    if record.address:
+        flags |= HAS_ADDRESS
+    if record.email:
+        flags |= HAS_EMAIL
+    birthday = record.birthday.ordinal if record.birthday else 0
+
+    parts = [
+        RECORD.pack(flags, birthday, len(record.phones), len(record.notes)),
+        _pack_string(record.name.value, SHORT_LENGTH),
+        struct.pack(f"<{len(record.phones)}Q", *(phone.number for phone in record.phones)),
+    ]
+    if record.address:
+        parts.append(_pack_string(record.address.value))
+    if record.email:
+        parts.append(_pack_string(record.email.value))
+    parts.extend(_pack_string(note.value) for note in record.notes)
+    return b"".join(parts)
+
+
+def decode_record(payload):
+    flags, birthday, phone_count, note_count = RECORD.unpack_from(payload)
+    name, offset = _unpack_string(payload, RECORD.size, SHORT_LENGTH)
+    record = Record(name)
+    if birthday:
+        record.birthday = Birthday.from_ordinal(birthday)
+
+    for number in struct.unpack_from(f"<{phone_count}Q", payload, offset):
+        record.phones.append(Phone.from_number(number))
+    offset += 8 * phone_count
+
+    if flags & HAS_ADDRESS:
+        address, offset = _unpack_string(payload, offset)
+        record.address = Address(address)
+    if flags & HAS_EMAIL:
+        email, offset = _unpack_string(payload, offset)
+        record.email = Email.from_valid(email)
+    for _ in range(note_count):
+        note, offset = _unpack_string(payload, offset)
+        record.notes.append(Note(note))
+    return record
+
+
+def _compress(data, compression):
+    if compression == COMPRESSION_ZLIB:
+        return zlib.compress(data)
+    if compression == COMPRESSION_LZMA:
+        return lzma.compress(data)
+    return data
+
+
+def _decompress(data, compression):
+    if compression == COMPRESSION_ZLIB:
+        return zlib.decompress(data)
+    if compression == COMPRESSION_LZMA:
+        return lzma.decompress(data)
+    return data
+
+
+class SnapshotWriter:
+    """
+    Streams records into a snapshot file.
+
+    Layout of the file (all integers little-endian):
+        header: magic "AX51BOOK", version (u16), compression (u16), record count (u64),
+            entries offset (u64), positions offset (u64), sequence (u64): the number of
+            the last save (see journal_commit) whose changes the snapshot includes
+        blocks: encoded records (see encode_record), back to back; with compression
+            they are grouped into blocks of about BLOCK_SIZE bytes compressed with
+            zlib or lzma
+        entries: for every record, in the order they were added, the offset and
+            length of its block, its offset and length inside the block, and its
+            name (u16 length + UTF-8)
+        positions: offsets of the entries (u64), sorted by name, for binary search
+
+    Version 1 files held pickled records and a shorter entry (offset, length, name)
+    without blocks, version 2 files had no sequence number; both can still be read
+    so that they can be converted.
+
+    Attributes:
+        file: Binary file opened for writing, must be seekable.
+        compression (int): One of the COMPRESSION_* constants.
+        sequence (int): Sequence number written to the header.
+
+    Methods:
+        add(name: str, payload: bytes): Writes an already encoded record.
+        add_record(record: Record): Encodes and writes a record.
+        close(): Writes the last block, the index and the header.
+    """
+
+    def __init__(self, file, compression=COMPRESSION_NONE, sequence=0):
+        self.file = file
+        self.compression = compression
+        self.sequence = sequence
+        self.file.write(bytes(HEADER.size))
+        self.offset = HEADER.size
+        self.entries = []
+        self.block_entries = []
+        self.block_payloads = []
+        self.block_size = 0
+
+    def add(self, name, payload):
+        if self.compression == COMPRESSION_NONE:
+            self.file.write(payload)
+            self.entries.append((name.encode(), self.offset, len(payload), 0, len(payload)))
+            self.offset += len(payload)
+            return
+
+        self.block_entries.append((name.encode(), self.block_size, len(payload)))
+        self.block_payloads.append(payload)
+        self.block_size += len(payload)
+        if self.block_size >= BLOCK_SIZE:
+            self._write_block()
+
+    def add_record(self, record):
+        self.add(record.name.value, encode_record(record))
+
+    def _write_block(self):
+        if not self.block_entries:
+            return
+        data = _compress(b"".join(self.block_payloads), self.compression)
+        self.file.write(data)
+        for name, inner_offset, length in self.block_entries:
+            self.entries.append((name, self.offset, len(data), inner_offset, length))
+        self.offset += len(data)
+        self.block_entries = []
+        self.block_payloads = []
+        self.block_size = 0
+
+    def close(self):
+        self._write_block()
+        entries_offset = self.offset
+        positions = []
+        for name, block_offset, block_length, inner_offset, length in self.entries:
+            positions.append((name, self.offset))
+            self.file.write(ENTRY.pack(block_offset, block_length, inner_offset, length, len(name)))
+            self.file.write(name)
+            self.offset += ENTRY.size + len(name)
+
+        positions_offset = self.offset
+        positions.sort()
+        self.file.write(b"".join(POSITION.pack(position) for _, position in positions))
+
+        self.file.seek(0)
+        self.file.write(HEADER.pack(
+            MAGIC, VERSION, self.compression, len(self.entries), entries_offset, positions_offset,
+            self.sequence,
+        ))
+        self.file.seek(0, 2)
+
+
+class SnapshotReader:
+    """
+    Reads records from a snapshot file on demand.
+
+    The file is memory-mapped and only the header is read when it is opened.
+    Records are looked up with a binary search over the sorted positions and
+    decoded only when asked for, so opening does not depend on the size of
+    the book. The last decompressed block is kept for sequential reads.
+
+    Attributes:
+        version (int): Format version of the file.
+        compression (int): One of the COMPRESSION_* constants.
+        count (int): Number of records in the snapshot.
+        sequence (int): Number of the last save included in the snapshot, 0 for older versions.
+        identity (tuple): Inode, size and modification time of the file, which tell it from
+            the files that replace it.
+
+    Methods:
+        entries(): Yields the name and location of every record, in file order.
+        find(name: str): Returns the location of a record, or None.
+        payload(location): Returns the encoded record at location.
+        read_at(location): Returns the decoded record at location.
+        read(name: str): Returns the decoded record, or None.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            status = os.fstat(file.fileno())
+        self.identity = (status.st_ino, status.st_size, status.st_mtime_ns)
+        magic, self.version = VERSION_PREFIX.unpack_from(self.map)
+        if magic != MAGIC or self.version not in (1, 2, VERSION):
+            raise ValueError(f"Unsupported snapshot file {path}")
+        if self.version == VERSION:
+            (_, _, self.compression, self.count, self.entries_offset,
+             self.positions_offset, self.sequence) = HEADER.unpack_from(self.map)
+        else:
+            (_, _, self.compression, self.count,
+             self.entries_offset, self.positions_offset) = HEADER_V2.unpack_from(self.map)
+            self.sequence = 0
+        if self.version == 1:
+            self.compression = COMPRESSION_NONE
+        self.entry = ENTRY_V1 if self.version == 1 else ENTRY
+        self.cached_block = (None, None)
+
+    def _entry(self, position):
+        fields = self.entry.unpack_from(self.map, position)
+        start = position + self.entry.size
+        name = self.map[start:start + fields[-1]]
+        if self.version == 1:
+            offset, length, _ = fields
+            return name, (offset, length, 0, length)
+        return name, fields[:-1]
+
+    def entries(self):
+        position = self.entries_offset
+        for _ in range(self.count):
+            name, location = self._entry(position)
+            position += self.entry.size + len(name)
+            yield name.decode(), location
+
+    def find(self, name):
+        key = name.encode()
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            position, = POSITION.unpack_from(self.map, self.positions_offset + middle * POSITION.size)
+            entry_name, location = self._entry(position)
+            if entry_name < key:
+                low = middle + 1
+            elif entry_name > key:
+                high = middle
+            else:
+                return location
+        return None
+
+    def payload(self, location):
+        block_offset, block_length, inner_offset, length = location
+        if self.compression == COMPRESSION_NONE:
+            return self.map[block_offset:block_offset + length]
+
+        cached_offset, block = self.cached_block
+        if cached_offset != block_offset:
+            block = _decompress(self.map[block_offset:block_offset + block_length], self.compression)
+            self.cached_block = (block_offset, block)
+        return block[inner_offset:inner_offset + length]
+
+    def read_at(self, location):
+        payload = self.payload(location)
+        if self.version == 1:
+            return pickle.loads(payload)
+        return decode_record(payload)
+
+    def read(self, name):
+        location = self.find(name)
+        if location is None:
+            return None
+        return self.read_at(location)
+
+
+JOURNAL_MAGIC = b"AX51JRN2"
+# Journals written before saves were numbered, without commit entries
+JOURNAL_MAGIC_V1 = b"AX51JRNL"
+
+# Journal entries: operation, payload length, CRC32 of the payload
+JOURNAL_ENTRY = struct.Struct("<BII")
+JOURNAL_PUT = 1
+JOURNAL_DELETE = 2
+JOURNAL_COMMIT = 3
+SEQUENCE = struct.Struct("<Q")
+
+
+def _journal_entry(operation, payload):
+    return JOURNAL_ENTRY.pack(operation, len(payload), zlib.crc32(payload)) + payload
+
+
+def journal_entry(name, record):
+    """
+    Encodes one journal entry: the record stored under name, or its deletion when record is None.
+
+    A journal file starts with JOURNAL_MAGIC followed by entries: operation (u8),
+    payload length (u32) and CRC32 of the payload (u32), then the payload, which is
+    the encoded record for a put and the UTF-8 name for a delete. The entries of
+    one save are followed by a commit entry (see journal_commit).
+    """
+    if record is None:
+        return _journal_entry(JOURNAL_DELETE, name.encode())
+    return _journal_entry(JOURNAL_PUT, encode_record(record))
+
+
+def journal_commit(sequence):
+    """
+    Encodes the commit entry that ends the entries of a save, numbered sequence.
+
+    Saves are numbered one after another across all the processes sharing the
+    book, so the number of the last save a process has seen tells which entries
+    are new to it.
+    """
+    return _journal_entry(JOURNAL_COMMIT, SEQUENCE.pack(sequence))
+
+
+def is_legacy_journal(path):
+    with open(path, "rb") as file:
+        header = file.read(len(JOURNAL_MAGIC))
+    return bool(header) and header != JOURNAL_MAGIC
+
+
+def read_journal(file, after=0):
+    """
+    Yields the sequence number and the changes of every save in a journal file
+    numbered above after, the changes as a list of (name, record) pairs with
+    None as the record of a deletion.
+
+    The file is read from its current position: the start of the file, or where
+    an earlier read left it. Reading stops at the first entry that is cut short
+    or fails its checksum, which is what a crash (or a save still being written
+    by another process) leaves behind, and the file is left at the end of the
+    last complete save, so a later read picks up the saves appended meanwhile.
+    Records of saves numbered up to after are not decoded.
+
+    Journals written by older versions, as a stream of pickles or without
+    commit entries, are yielded as a single save numbered None.
+    """
+    if file.tell() == 0:
+        magic = file.read(len(JOURNAL_MAGIC))
+        if len(magic) < len(JOURNAL_MAGIC):
+            file.seek(0)
+            return
+        if magic != JOURNAL_MAGIC:
+            file.seek(0)
+            yield None, list(_read_legacy_journal(file, magic == JOURNAL_MAGIC_V1))
+            return
+
+    end = file.tell()
+    entries = []
+    while True:
+        header = file.read(JOURNAL_ENTRY.size)
+        if len(header) < JOURNAL_ENTRY.size:
+            break
+        operation, length, checksum = JOURNAL_ENTRY.unpack(header)
+        payload = file.read(length)
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            break
+        if operation != JOURNAL_COMMIT:
+            entries.append((operation, payload))
+            continue
+
+        end = file.tell()
+        sequence, = SEQUENCE.unpack(payload)
+        if sequence > after:
+            yield sequence, [_decode_entry(operation, payload) for operation, payload in entries]
+        entries = []
+    file.seek(end)
+
+
+def _decode_entry(operation, payload):
+    if operation == JOURNAL_PUT:
+        record = decode_record(payload)
+        return record.name.value, record
+    return payload.decode(), None
+
+
+def _read_legacy_journal(file, entries):
+    if entries:
+        file.seek(len(JOURNAL_MAGIC_V1))
+        while True:
+            header = file.read(JOURNAL_ENTRY.size)
+            if len(header) < JOURNAL_ENTRY.size:
+                return
+            operation, length, checksum = JOURNAL_ENTRY.unpack(header)
+            payload = file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                return
+            yield _decode_entry(operation, payload)
+
+    while True:
+        try:
+            operation, name, record = pickle.load(file)
+        except (EOFError, pickle.UnpicklingError, ValueError):
+            return
+        yield name, record if operation == "put" else None
@@ -0,0 +1,204 @@
+from assistant_x.helpers import CommandError
+from functools import wraps
+import atexit
+import math
+import os
+import sys
+import threading
+import time
+
+
+# Directory the profile of a session is written to when it ends, see start_profiling
+PROFILE_ENV = "ASSISTANT_X_PROFILE"
+
+# Latencies are counted in buckets this much wider than the previous one; percentiles
+# are reported as the middle of their bucket, so within 5% of the real value whatever
+# the number of calls
+BUCKET_GROWTH = 1.1
+
+# Upper bound of the first bucket, in seconds
+SHORTEST_LATENCY = 1e-6
+
+# Allocation sites listed in the memory part of a profile
+MEMORY_TOP = 50
+
+
+class Histogram:
+    """
+    Latencies of one operation, counted in logarithmic buckets so that the
+    memory used does not grow with the number of calls.
+
+    Attributes:
+        calls (int): Number of calls.
+        errors (int): Calls that raised or replied with a CommandError.
+        total (float): Seconds spent in all calls.
+        longest (float): Seconds taken by the slowest call.
+        size (int): Bytes written by all calls, for operations that write.
+        buckets (dict): Number of calls by bucket, see BUCKET_GROWTH.
+
+    Methods:
+        add(seconds: float, size: int = None, failed: bool = False): Counts a call.
+        wrote(size: int): Counts bytes written by a call counted apart.
+        percentile(fraction: float): Returns the latency that fraction of the calls did not exceed.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.longest = 0.0
+        self.size = None
+        self.buckets = {}
+
+    def add(self, seconds, size=None, failed=False):
+        self.calls += 1
+        self.errors += failed
+        self.total += seconds
+        self.longest = max(self.longest, seconds)
+        if size is not None:
+            self.wrote(size)
+        bucket = 0 if seconds <= SHORTEST_LATENCY else math.ceil(math.log(seconds / SHORTEST_LATENCY, BUCKET_GROWTH))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def wrote(self, size):
+        self.size = (self.size or 0) + size
+
+    def percentile(self, fraction):
+        if not self.calls:
+            return 0.0
+        rank = max(1, math.ceil(fraction * self.calls))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                # The geometric middle of the bucket, which the slowest call may be below
+                return min(SHORTEST_LATENCY * BUCKET_GROWTH ** max(bucket - 0.5, 0), self.longest)
+        return self.longest
+
+
+class Stats:
+    """
+    Call counts, latencies and bytes written of the commands and of the storage
+    of the book, since the process started.
+
+    Attributes:
+        histograms (dict): Histogram of every operation, by (kind, name); kind is
+            "command" for the handlers and "storage" for loads, saves, refreshes and compactions.
+        lock (threading.Lock): Held while a call is counted, as handlers and saves run in several threads.
+
+    Methods:
+        record(kind: str, name: str, seconds: float, size: int = None, failed: bool = False): Counts a call.
+        wrote(kind: str, name: str, size: int): Counts bytes written by a call timed apart, e.g. with timed.
+        rows(): Returns the operations as (kind, name, histogram) tuples, commands first.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def record(self, kind, name, seconds, size=None, failed=False):
+        with self.lock:
+            histogram = self.histograms.get((kind, name))
+            if histogram is None:
+                histogram = self.histograms[kind, name] = Histogram()
+            histogram.add(seconds, size, failed)
+
+    def wrote(self, kind, name, size):
+        with self.lock:
+            histogram = self.histograms.get((kind, name))
+            if histogram is None:
+                histogram = self.histograms[kind, name] = Histogram()
+            histogram.wrote(size)
+
+    def rows(self):
+        with self.lock:
+            return [(kind, name, histogram) for (kind, name), histogram in sorted(self.histograms.items())]
+
+
+STATS = Stats()
+
+
+def instrument(kind, name, func):
+    """Returns func wrapped to count its calls in STATS under (kind, name); attributes of func are kept."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            STATS.record(kind, name, time.perf_counter() - started, failed=True)
+            raise
+        STATS.record(kind, name, time.perf_counter() - started, failed=isinstance(result, CommandError))
+        return result
+
+    return wrapper
+
+
+def timed(kind, name):
+    """Decorator counting the calls of a function in STATS, see instrument."""
+    def decorate(func):
+        return instrument(kind, name, func)
+
+    return decorate
+
+
+_profilers = []
+
+
+def _start_profiler():
+    import cProfile
+
+    profiler = cProfile.Profile()
+    _profilers.append(profiler)
+    profiler.enable()
+
+
+def _profile_thread(frame, event, arg):
+    # Set for new threads by threading.setprofile, runs once on their first call
+    sys.setprofile(None)
+    _start_profiler()
+
+
+def start_profiling():
+    """
+    Profiles the session when PROFILE_ENV names a directory: calls with
+    cProfile, allocations with tracemalloc. Both are written to the directory
+    when the process exits, as assistant_x-<pid>.prof (read it with
+    "python -m pstats") and assistant_x-<pid>.memory.txt.
+    Returns the directory, or None when profiling is off.
+    """
+    directory = os.environ.get(PROFILE_ENV)
+    if not directory:
+        return None
+    import tracemalloc
+
+    os.makedirs(directory, exist_ok=True)
+    tracemalloc.start()
+    _start_profiler()
+    if sys.version_info < (3, 12):
+        # Before 3.12 a profiler only sees the thread it was enabled in
+        threading.setprofile(_profile_thread)
+    atexit.register(write_profile, directory)
+    return directory
+
+
+def write_profile(directory):
+    import pstats
+    import tracemalloc
+
+    threading.setprofile(None)
+    for profiler in _profilers:
+        profiler.disable()
+    base = os.path.join(directory, f"assistant_x-{os.getpid()}")
+
+    profile = pstats.Stats(*_profilers)
+    profile.dump_stats(base + ".prof")
+
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    with open(base + ".memory.txt", "w", encoding="utf-8") as file:
+        file.write(f"Traced memory: {current / 1024 / 1024:.1f} MiB at exit, {peak / 1024 / 1024:.1f} MiB at peak\n")
+        for statistic in snapshot.statistics('lineno')[:MEMORY_TOP]:
+            file.write(f"{statistic}\n")
+    print(f"Profile written to {base}.prof and {base}.memory.txt", file=sys.stderr)
@@ -0,0 +1,94 @@
+import datetime
+import os
+import re
+
+
+PHONE_PATTERN = re.compile(r'[0-9]{10}')
+EMAIL_PATTERN = re.compile(r'[A-Za-z0-9._%-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,4}')
+BIRTHDAY_FORMAT = "%d.%m.%Y"
+
+# Columns with fewer values than this in total are validated in this process
+PARALLEL_THRESHOLD = 200000
+
+# Values sent to a worker process at a time
+CHUNK_SIZE = 50000
+
+
+def check_phone(value):
+    """Returns the phone number as an int, or None if it is not exactly 10 digits."""
+    if PHONE_PATTERN.fullmatch(value):
+        return int(value)
+    return None
+
+
+def check_email(value):
+    """Returns the email unchanged, or None if it does not look like an email address."""
+    if EMAIL_PATTERN.fullmatch(value):
+        return value
+    return None
+
+
+def check_birthday(value):
+    """Returns the DD.MM.YYYY date as a day ordinal, or None if it is not a valid date."""
+    # Fast path for the usual zero-padded form, strptime handles the rest (e.g. "1.5.1990")
+    if len(value) == 10 and value[2] == '.' and value[5] == '.' and value.isascii():
+        day, month, year = value[:2], value[3:5], value[6:]
+        if day.isdigit() and month.isdigit() and year.isdigit():
+            try:
+                return datetime.date(int(year), int(month), int(day)).toordinal()
+            except ValueError:
+                return None
+    try:
+        return datetime.datetime.strptime(value, BIRTHDAY_FORMAT).toordinal()
+    except ValueError:
+        return None
+
+
+VALIDATORS = {
+    'phone': check_phone,
+    'email': check_email,
+    'birthday': check_birthday,
+}
+
+
+def validate_column(kind, values):
+    """Validates values of one kind (see VALIDATORS), returning a verdict for every value."""
+    return list(map(VALIDATORS[kind], values))
+
+
+def _validate_chunk(task):
+    kind, values = task
+    return validate_column(kind, values)
+
+
+def validate_columns(columns, processes=None):
+    """
+    Validates columns of raw values, given as a dict of kind (see VALIDATORS) to
+    a list of strings.
+
+    Returns a dict with the same keys holding a verdict for every value: the
+    value in the form it is stored in (see check_phone, check_email and
+    check_birthday), or None when the value is invalid.
+
+    Large inputs are split into chunks validated by a pool of processes
+    (os.cpu_count() of them unless processes is given); small ones, or any
+    input on a single CPU, are validated in this process.
+    """
+    processes = processes or os.cpu_count() or 1
+    total = sum(len(values) for values in columns.values())
+    if processes < 2 or total < PARALLEL_THRESHOLD:
+        return {kind: validate_column(kind, values) for kind, values in columns.items()}
+
+    # Imported here, since the pool is only needed for very large inputs
+    from concurrent.futures import ProcessPoolExecutor
+
+    tasks = [
+        (kind, values[start:start + CHUNK_SIZE])
+        for kind, values in columns.items()
+        for start in range(0, len(values), CHUNK_SIZE)
+    ]
+    verdicts = {kind: [] for kind in columns}
+    with ProcessPoolExecutor(processes) as executor:
+        for (kind, _), chunk in zip(tasks, executor.map(_validate_chunk, tasks)):
+            verdicts[kind].extend(chunk)
+    return verdicts
@@ -8,11 +8,12 @@ setup(
     author='Area 51 Team',
     author_email='',
     license='MIT',
-    packages=find_namespace_packages(),
+    packages=find_namespace_packages(exclude=['tests', 'tests.*']),
     install_requires=['colorama'],
     entry_points={
         'console_scripts': [
-            'assistant_x = assistant_x.main:main'
+            'assistant_x = assistant_x.main:main',
+            'assistant_x-import = assistant_x.importer:main',
         ]
     }
 )
\ No newline at end of file
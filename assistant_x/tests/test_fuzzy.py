@@ -0,0 +1,80 @@
+from assistant_x.indexes import FuzzyIndex, similar_names
+from types import SimpleNamespace
+import random
+import statistics
+import time
+
+FIRST = """James Mary John Patricia Robert Jennifer Michael Linda William Elizabeth David Barbara Richard Susan
+Joseph Jessica Thomas Sarah Charles Karen Daniel Lisa Matthew Betty Anthony Margaret Mark Sandra Donald Ashley
+Steven Kimberly Paul Emily Andrew Donna Joshua Michelle Kenneth Dorothy Kevin Carol Brian Amanda George Melissa
+Olena Taras Iryna Andrii Oksana Yulia Kateryna Mykola Bohdan Natalia Sofia Ivan Petro Halyna""".split()
+
+
+def make_names(count, seed=5):
+    rnd = random.Random(seed)
+    surnames = set()
+    while len(surnames) < count // 4:
+        surname = rnd.choice("b br ch d f g h k l m n p r s st t v z".split()) + rnd.choice("a e i o u ai ou".split())
+        surname += rnd.choice("n r l s t nd ck ll".split()) + rnd.choice("a e i o ".split())
+        surname += rnd.choice("son ley ner man ez enko ski berg ford field".split())
+        surnames.add(surname.strip().capitalize())
+    surnames = sorted(surnames)
+    names = {}
+    while len(names) < count:
+        # A few common first and last names, and a long tail of rare ones
+        first = FIRST[min(int(rnd.paretovariate(0.8)) - 1, len(FIRST) - 1)]
+        if rnd.random() < 0.5:
+            surname = surnames[min(int(rnd.paretovariate(0.6)) - 1, len(surnames) - 1)]
+        else:
+            surname = rnd.choice(surnames)
+        names[f"{first} {surname}"] = None
+    return list(names)
+
+
+def make_typos(names, count, seed=7):
+    # Queries one or two edits off names, none of them touching the space
+    rnd = random.Random(seed)
+    queries = []
+    for name in rnd.sample(names, count):
+        query = name
+        for _ in range(rnd.randint(1, 2)):
+            position = rnd.choice([i for i, char in enumerate(query) if char != ' '])
+            edit = rnd.choice(('delete', 'insert', 'replace'))
+            letter = rnd.choice('abcdefghijklmnopqrstuvwxyz')
+            if edit == 'delete' and ' ' not in query[max(position - 1, 0):position + 2]:
+                query = query[:position] + query[position + 1:]
+            elif edit == 'insert':
+                query = query[:position] + letter + query[position:]
+            else:
+                query = query[:position] + letter + query[position + 1:]
+        queries.append(query)
+    return queries
+
+
+def build(names):
+    index = FuzzyIndex()
+    index.build(SimpleNamespace(data=names))
+    return index
+
+
+def test_search_finds_what_checking_every_name_finds():
+    names = make_names(2000)
+    index = build(names)
+    for query in make_typos(names, 100):
+        assert index.search(query) == similar_names(query, names)
+
+
+def test_search_takes_under_a_millisecond_on_a_large_book():
+    names = make_names(100_000)
+    index = build(names)
+    timings = []
+    for query in make_typos(names, 500):
+        start = time.perf_counter()
+        index.search(query)
+        timings.append(time.perf_counter() - start)
+    assert statistics.median(timings) < 0.001
+
+
+def test_search_gives_up_at_the_deadline():
+    index = build(make_names(3000))
+    assert index.search("Mary Brandson", deadline=time.perf_counter() - 1) == []
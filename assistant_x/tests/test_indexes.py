@@ -0,0 +1,135 @@
+from assistant_x import storage
+from assistant_x.indexes import matches, tokenize
+from assistant_x.models import Birthday, Record
+import datetime
+import os
+import pytest
+import random
+
+FIRST = "John Johanna Mary Maria Olena Oleh Ivan Iryna Peter Petro Anna Andrii".split()
+LAST = "Smith Smithson Doe Shevchenko Franko Kovalenko Brown Browning Lee Leeds".split()
+STREETS = "Main Oak Shevchenka Franka Sunset".split()
+CITIES = "Kyiv Lviv Boston Odesa New York".split()
+WORDS = "call about meeting project lunch gift invoice paid back tomorrow urgent".split()
+DOMAINS = "gmail.com ukr.net example.org".split()
+
+
+def make_record(rnd, name):
+    record = Record(name)
+    for _ in range(rnd.randint(0, 2)):
+        record.add_phone(f"{rnd.randrange(10 ** 10):010d}")
+    if rnd.random() < 0.8:
+        record.add_email(f"{name.split()[0].lower()}{rnd.randrange(100)}@{rnd.choice(DOMAINS)}")
+    if rnd.random() < 0.8:
+        record.add_address(f"{rnd.randint(1, 99)} {rnd.choice(STREETS)} St, {rnd.choice(CITIES)}")
+    if rnd.random() < 0.8:
+        date = datetime.date(1960, 1, 1) + datetime.timedelta(days=rnd.randrange(20000))
+        record.add_birthday(Birthday(date.strftime("%d.%m.%Y")))
+    for _ in range(rnd.randint(0, 2)):
+        record.add_note(" ".join(rnd.choices(WORDS, k=4)))
+    return record
+
+
+@pytest.fixture
+def book_path(tmp_path, monkeypatch):
+    # A book in a snapshot, then changed in the journal on top of it
+    rnd = random.Random(3)
+    file_storage = storage.FileStorage(str(tmp_path))
+    book = file_storage.load()
+    for number in range(400):
+        book.add_record(make_record(rnd, f"{rnd.choice(FIRST)} {rnd.choice(LAST)} {number}"))
+    monkeypatch.setattr(storage, 'COMPACT_THRESHOLD', 1)
+    file_storage.save(book)
+    file_storage.compaction.join()
+    monkeypatch.undo()
+
+    for number in range(0, 400, 7):
+        book.delete(next(name for name in book.data if name.endswith(f" {number}")))
+    for name in list(book.data)[::11]:
+        book.add_record(make_record(rnd, name))
+    for number in range(400, 430):
+        book.add_record(make_record(rnd, f"{rnd.choice(FIRST)} {rnd.choice(LAST)} {number}"))
+    file_storage.save(book)
+    return str(tmp_path)
+
+
+def fresh_books(path):
+    # A process that builds the indexes and keeps them, then one that reads them back
+    first = storage.FileStorage(path).load()
+    yield first
+    yield storage.FileStorage(path).load()
+
+
+def find_queries(book):
+    rnd = random.Random(5)
+    records = list(book.data.values())
+    queries = ["john", "SMITH", "a", "oh", "leeds 4", "Mar*", "o*", "nobody", "1", "42"]
+    for record in rnd.sample(records, 40):
+        if record.phones:
+            phone = record.phones[0].value
+            start = rnd.randrange(8)
+            queries.append(phone[start:start + rnd.randint(2, 6)])
+        if record.email:
+            queries += [f"email:{record.email.value.upper()}", f"domain:{record.email.value.split('@')[1]}"]
+        if record.address:
+            queries += [f"address:{record.address.value.split(',')[0]}", f"city:{rnd.choice(CITIES)}"]
+    return queries
+
+
+def test_find_gives_what_checking_every_record_gives(book_path):
+    for book in fresh_books(book_path):
+        for query in find_queries(book):
+            expected = [name for name, record in book.data.items() if matches(record, query)]
+            assert book.find_names(query) == expected, query
+    assert os.path.exists(os.path.join(book_path, storage.INDEX_FILE.format(kind='phones')))
+
+
+def test_find_notes_gives_what_checking_every_note_gives(book_path):
+    for book in fresh_books(book_path):
+        for terms in ("meeting", "urgent lunch", "nothing", "PAID"):
+            expected = {
+                (name, note_index)
+                for name, record in book.data.items()
+                for note_index, note in enumerate(record.notes)
+                if set(tokenize(terms)) & set(tokenize(note.value))
+            }
+            assert {(name, note_index) for name, note_index, _, _ in book.find_notes(terms)} == expected
+
+
+def test_upcoming_birthdays_give_what_checking_every_record_gives(book_path):
+    for book in fresh_books(book_path):
+        for today in (datetime.date(2025, 1, 1), datetime.date(2024, 2, 27), datetime.date(2023, 12, 20)):
+            for days in (0, 7, 45, 400):
+                expected = {
+                    (record.name.value, record.days_to_birthday(today))
+                    for record in book.data.values()
+                    if record.birthday and record.days_to_birthday(today) <= days
+                }
+                upcoming = book.upcoming_birthdays(days, today)
+                assert {(record.name.value, days_left) for record, days_left in upcoming} == expected
+
+
+def test_completion_gives_what_checking_every_name_gives(book_path):
+    for book in fresh_books(book_path):
+        for prefix in ("jo", "Mar", "olena shevchenko", "x"):
+            expected = sorted(name for name in book.data if name.casefold().startswith(prefix.casefold()))
+            assert book.complete_names(prefix, limit=1000) == expected
+
+
+def test_index_file_of_another_snapshot_is_not_used(book_path, monkeypatch):
+    book = storage.FileStorage(book_path).load()
+    book.find_names("john")
+    index_path = os.path.join(book_path, storage.INDEX_FILE.format(kind='names'))
+    stamp = os.stat(index_path).st_mtime_ns
+
+    # A compaction replaces the snapshot the file was built from
+    monkeypatch.setattr(storage, 'COMPACT_THRESHOLD', 1)
+    file_storage = storage.FileStorage(book_path)
+    book = file_storage.load()
+    book.add_record(Record("John Newcomer"))
+    file_storage.save(book)
+    file_storage.compaction.join()
+
+    book = storage.FileStorage(book_path).load()
+    assert "John Newcomer" in book.find_names("john")
+    assert os.stat(index_path).st_mtime_ns != stamp
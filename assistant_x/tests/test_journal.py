@@ -0,0 +1,75 @@
+from assistant_x import storage
+from assistant_x.models import Record
+import os
+import pytest
+
+
+def save_contacts(file_storage, book, *names):
+    for name in names:
+        record = Record(name)
+        record.add_phone("0123456789")
+        book.add_record(record)
+        file_storage.save(book)
+
+
+def contents(book):
+    return {name: [phone.value for phone in record.phones] for name, record in book.data.items()}
+
+
+@pytest.fixture
+def saved(tmp_path):
+    # Three saves, the last one of them the last entries of the journal
+    file_storage = storage.FileStorage(str(tmp_path))
+    book = file_storage.load()
+    save_contacts(file_storage, book, "First Save", "Second Save")
+    size = os.path.getsize(file_storage.journal_path)
+    save_contacts(file_storage, book, "Third Save")
+    return file_storage.journal_path, size
+
+
+def test_truncated_tail_keeps_the_earlier_saves(tmp_path, saved):
+    journal_path, size = saved
+    with open(journal_path, "r+b") as file:
+        file.truncate(os.path.getsize(journal_path) - 3)
+    book = storage.FileStorage(str(tmp_path)).load()
+    assert sorted(book.data) == ["First Save", "Second Save"]
+
+
+def test_corrupted_tail_keeps_the_earlier_saves(tmp_path, saved):
+    journal_path, size = saved
+    with open(journal_path, "r+b") as file:
+        file.seek(size + 20)
+        byte = file.read(1)
+        file.seek(size + 20)
+        file.write(bytes([byte[0] ^ 0xFF]))
+    book = storage.FileStorage(str(tmp_path)).load()
+    assert sorted(book.data) == ["First Save", "Second Save"]
+
+
+def test_save_after_a_torn_tail_is_kept(tmp_path, saved):
+    journal_path, size = saved
+    with open(journal_path, "r+b") as file:
+        file.truncate(os.path.getsize(journal_path) - 3)
+    file_storage = storage.FileStorage(str(tmp_path))
+    book = file_storage.load()
+    save_contacts(file_storage, book, "Fourth Save")
+    assert sorted(storage.FileStorage(str(tmp_path)).load().data) == ["First Save", "Fourth Save", "Second Save"]
+
+
+def test_compaction_then_reload_gives_the_same_book(tmp_path, monkeypatch):
+    file_storage = storage.FileStorage(str(tmp_path))
+    book = file_storage.load()
+    save_contacts(file_storage, book, *(f"Contact {number}" for number in range(50)))
+    book.delete("Contact 7")
+    book.change_phone("Contact 8", "9876543210")
+    file_storage.save(book)
+    before = contents(storage.FileStorage(str(tmp_path)).load())
+
+    monkeypatch.setattr(storage, 'COMPACT_THRESHOLD', 1)
+    save_contacts(file_storage, book, "Last Contact")
+    file_storage.compaction.join()
+    assert not os.path.exists(file_storage.journal_path)
+
+    before["Last Contact"] = ["0123456789"]
+    assert contents(storage.FileStorage(str(tmp_path)).load()) == before
+    assert contents(book) == before
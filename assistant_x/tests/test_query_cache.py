@@ -0,0 +1,79 @@
+from assistant_x import handlers, storage
+from assistant_x.main import dispatch, get_handler
+from assistant_x.models import Record
+from collections import OrderedDict
+import pytest
+import threading
+
+
+@pytest.fixture(params=[storage.FileStorage, storage.SQLiteStorage])
+def backend(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, '_storage', request.param(str(tmp_path)))
+    monkeypatch.setattr(handlers, '_query_cache', OrderedDict())
+    return request.param
+
+
+def load_book():
+    book = storage.get_storage().load()
+    book.add_record(Record("John Smith"))
+    storage.get_storage().save(book)
+    return book
+
+
+def test_repeated_query_is_answered_from_the_cache(backend, tmp_path):
+    book = load_book()
+    first = dispatch(['find', 'John'], book)
+    assert dispatch(['find', 'John'], book) is first
+    assert len(handlers._query_cache) == 1
+
+
+def test_save_made_elsewhere_invalidates_the_cache(backend, tmp_path):
+    book = load_book()
+    first = dispatch(['find', 'John'], book)
+
+    other = backend(str(tmp_path))
+    other_book = other.load()
+    other_book.add_record(Record("John Doe"))
+    other.save(other_book)
+
+    second = dispatch(['find', 'John'], book)
+    assert second is not first
+    assert [contact.name.value for contact in second] == ["John Smith", "John Doe"]
+
+
+def test_large_results_are_not_cached(backend, tmp_path, monkeypatch):
+    monkeypatch.setattr(handlers, 'QUERY_CACHE_ROWS', 10)
+    book = load_book()
+    for number in range(5):
+        book.add_record(Record(f"John Doe{number}"))
+    storage.get_storage().save(book)
+
+    assert len(dispatch(['find', 'John'], book)) == 6
+    assert len(handlers._query_cache) == 0
+    dispatch(['find', 'Doe1'], book)
+    assert len(handlers._query_cache) == 1
+
+
+def test_read_only_commands_wait_for_a_background_flush(backend, tmp_path):
+    book = load_book()
+    flushing, flushed = threading.Event(), threading.Event()
+
+    def flush():
+        # What a flush holds while it applies saves made elsewhere to the book
+        with storage.get_storage().lock:
+            flushing.set()
+            flushed.wait(5)
+
+    flusher = threading.Thread(target=flush)
+    flusher.start()
+    flushing.wait(5)
+    replies = []
+    reader = threading.Thread(target=lambda: replies.append(get_handler('find')(['find', 'John'], book=book)))
+    reader.start()
+    reader.join(0.2)
+    assert replies == []
+
+    flushed.set()
+    reader.join()
+    flusher.join()
+    assert [contact.name.value for contact in replies[0]] == ["John Smith"]
@@ -0,0 +1,16 @@
+from assistant_x import handlers, storage
+from assistant_x.server import BookServer
+from collections import OrderedDict
+import asyncio
+
+
+def test_params_with_spaces_are_passed_as_one_argument(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, '_storage', storage.FileStorage(str(tmp_path)))
+    monkeypatch.setattr(handlers, '_query_cache', OrderedDict())
+    book = storage.get_storage().load()
+    server = BookServer(book)
+
+    asyncio.run(server.call('add', ["John Smith", "0501234567"]))
+    asyncio.run(server.call('add-address', ["John Smith", "1 Main St, Kyiv"]))
+    assert book.find("John Smith").address.value == "1 Main St, Kyiv"
+    assert asyncio.run(server.call('find', ["John Smith"]))
@@ -0,0 +1,33 @@
+from assistant_x.importer import build_records
+from assistant_x.models import MAX_PHONES, Record
+from assistant_x.snapshot import decode_record, encode_record
+import pytest
+
+
+def make_record(phone_count):
+    record = Record("Many Phones")
+    for number in range(phone_count):
+        record.add_phone(f"{number:010d}")
+    return record
+
+
+def test_record_with_most_phones_round_trips():
+    record = decode_record(encode_record(make_record(MAX_PHONES)))
+    assert len(record.phones) == MAX_PHONES
+    assert record.phones[-1].value == f"{MAX_PHONES - 1:010d}"
+
+
+def test_add_phone_refuses_more_than_can_be_stored():
+    record = make_record(MAX_PHONES)
+    with pytest.raises(ValueError):
+        record.add_phone("1234567890")
+    assert len(record.phones) == MAX_PHONES
+    encode_record(record)
+
+
+def test_import_skips_rows_with_too_many_phones():
+    phones = [f"{number:010d}" for number in range(MAX_PHONES + 1)]
+    rows = [(2, {'name': "Many Phones", 'phones': phones, 'notes': []})]
+    [(line_number, record, error)] = build_records(rows)
+    assert record is None
+    assert error == f"More than {MAX_PHONES} phone numbers"
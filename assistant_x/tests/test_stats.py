@@ -0,0 +1,31 @@
+from assistant_x import stats, storage
+from assistant_x.models import Record
+import pytest
+
+
+def test_percentiles_are_within_five_percent():
+    histogram = stats.Histogram()
+    latencies = [0.001 * 1.013 ** step for step in range(400)]
+    for seconds in latencies:
+        histogram.add(seconds)
+    for fraction in (0.5, 0.9, 0.99):
+        exact = latencies[int(fraction * len(latencies)) - 1]
+        assert abs(histogram.percentile(fraction) - exact) <= 0.05 * exact
+
+
+def test_failed_saves_are_counted(tmp_path, monkeypatch):
+    monkeypatch.setattr(stats, 'STATS', stats.Stats())
+    monkeypatch.setattr(storage, 'STATS', stats.STATS)
+    file_storage = storage.FileStorage(str(tmp_path))
+    book = file_storage.load()
+    book.add_record(Record("John Smith"))
+    file_storage.save(book)
+
+    book.add_record(Record("Mary Major"))
+    monkeypatch.setattr(storage, 'journal_commit', None)
+    with pytest.raises(TypeError):
+        file_storage.save(book)
+
+    histogram = stats.STATS.histograms['storage', 'save']
+    assert (histogram.calls, histogram.errors) == (2, 1)
+    assert histogram.size > 0
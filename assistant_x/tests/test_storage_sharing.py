@@ -0,0 +1,135 @@
+from assistant_x import storage
+from assistant_x.models import Record
+import os
+import pytest
+import threading
+
+
+@pytest.fixture(params=[storage.FileStorage, storage.SQLiteStorage])
+def backend(request):
+    return request.param
+
+
+def add(book, name, phone="0123456789"):
+    record = Record(name)
+    record.add_phone(phone)
+    book.add_record(record)
+
+
+def names(book):
+    return sorted(book.data)
+
+
+def wait_for_compaction(file_storage):
+    if file_storage.compaction is not None:
+        file_storage.compaction.join()
+
+
+def test_interleaved_saves_reach_both_books(backend, tmp_path):
+    first, second = backend(str(tmp_path)), backend(str(tmp_path))
+    first_book, second_book = first.load(), second.load()
+    expected = []
+    for number in range(20):
+        storage_, book = (first, first_book) if number % 2 else (second, second_book)
+        add(book, f"Contact {number}")
+        assert storage_.save(book) == []
+        expected.append(f"Contact {number}")
+
+    for storage_, book in ((first, first_book), (second, second_book)):
+        storage_.refresh(book)
+        assert names(book) == sorted(expected)
+    assert names(backend(str(tmp_path)).load()) == sorted(expected)
+
+
+def test_change_saved_first_wins_and_the_other_is_reported(backend, tmp_path):
+    first, second = backend(str(tmp_path)), backend(str(tmp_path))
+    first_book = first.load()
+    add(first_book, "John Smith")
+    first.save(first_book)
+    second_book = second.load()
+
+    first_book.change_phone("John Smith", "1111111111")
+    second_book.change_phone("John Smith", "2222222222")
+    assert first.save(first_book) == []
+    assert second.save(second_book) == ["John Smith"]
+    assert backend(str(tmp_path)).load().find("John Smith").phones[0].value == "1111111111"
+
+
+def test_compaction_while_another_process_appends(tmp_path, monkeypatch):
+    # Every save compacts the journal
+    monkeypatch.setattr(storage, 'COMPACT_THRESHOLD', 1)
+    first, second = storage.FileStorage(str(tmp_path)), storage.FileStorage(str(tmp_path))
+    first_book, second_book = first.load(), second.load()
+    expected = []
+    for number in range(30):
+        add(first_book, f"First {number}")
+        first.save(first_book)
+        add(second_book, f"Second {number}")
+        second.save(second_book)
+        expected += [f"First {number}", f"Second {number}"]
+    wait_for_compaction(first)
+    wait_for_compaction(second)
+
+    first.refresh(first_book)
+    second.refresh(second_book)
+    assert names(first_book) == names(second_book) == sorted(expected)
+    assert names(storage.FileStorage(str(tmp_path)).load()) == sorted(expected)
+
+
+def test_refresh_after_the_previous_journal_is_rotated_away(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'COMPACT_THRESHOLD', 1)
+    writer, idle = storage.FileStorage(str(tmp_path)), storage.FileStorage(str(tmp_path))
+    writer_book, idle_book = writer.load(), idle.load()
+    add(idle_book, "Unsaved Change")
+    # Two compactions: the saves the idle process has not read are only in the snapshot
+    for number in range(3):
+        add(writer_book, f"Contact {number}")
+        writer.save(writer_book)
+        wait_for_compaction(writer)
+    assert os.path.exists(writer.previous_path)
+
+    assert idle.refresh(idle_book) == []
+    assert names(idle_book) == ["Contact 0", "Contact 1", "Contact 2", "Unsaved Change"]
+    assert idle_book.changes == {"Unsaved Change"}
+    idle.save(idle_book)
+    assert names(storage.FileStorage(str(tmp_path)).load()) == names(idle_book)
+
+
+def test_sqlite_writers_in_two_threads_keep_every_save(tmp_path):
+    storage.SQLiteStorage(str(tmp_path)).load()
+    errors = []
+
+    def write(prefix):
+        writer = storage.SQLiteStorage(str(tmp_path))
+        book = writer.load()
+        try:
+            for number in range(50):
+                add(book, f"{prefix} {number}")
+                writer.save(book)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=write, args=(prefix,)) for prefix in ("First", "Second")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(storage.SQLiteStorage(str(tmp_path)).load().data) == 100
+
+
+def test_sqlite_save_waits_then_keeps_the_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'BUSY_TIMEOUT', 0.1)
+    holder, waiter = storage.SQLiteStorage(str(tmp_path)), storage.SQLiteStorage(str(tmp_path))
+    holder.load()
+    book = waiter.load()
+    add(book, "John Smith")
+
+    holder.connection.execute("BEGIN IMMEDIATE")
+    with pytest.raises(storage.BookLocked):
+        waiter.save(book)
+    holder.connection.rollback()
+
+    assert book.changes == {"John Smith"}
+    waiter.save(book)
+    assert names(storage.SQLiteStorage(str(tmp_path)).load()) == ["John Smith"]